@@ -66,6 +66,26 @@ class Backend(object):
         """
         raise NotImplementedError()
 
+    def get_collection_statistics(self, api_root, collection_id):
+        """
+        Fill:
+            Implement a summary of the content of a collection, cheap enough to be read
+            by planners and dashboards on every request
+
+        Args:
+            api_root (str): the name of the api_root.
+            collection_id (str): the id of the collection
+
+        Returns:
+            statistics for the collection (including):
+                how many objects and object versions it holds
+                how many objects of each type it holds
+                how many versions of each media type it holds
+                the first and last date_added
+
+        """
+        raise NotImplementedError()
+
     def get_api_root_information(self, api_root):
         """
         Fill:
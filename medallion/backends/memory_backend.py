@@ -1,418 +1,1203 @@
+import atexit
+import bisect
 import copy
+import functools
 import io
+import itertools
 import json
+import logging
+import os
+import sys
+import threading
 import uuid
 
 from six import string_types
 
 from ..common import (
-    SessionChecker, create_resource, datetime_to_float, datetime_to_string,
+    LRUCache, ReadWriteLock, SerializedEnvelope, SessionChecker,
+    create_resource, datetime_to_float, datetime_to_micros, datetime_to_string,
     determine_spec_version, determine_version, find_att, generate_status,
-    generate_status_details, get_timestamp, iterpath
+    generate_status_details, get_timestamp, parse_request_parameters,
+    string_to_datetime, string_to_micros
 )
 from ..exceptions import ProcessingError
-from ..filters.basic_filter import BasicFilter
+from ..filters.basic_filter import BasicFilter, index_manifest, pagination_key
+from ..filters.parallel_filter import ParallelFilter, ShardWorkers
 from .base import Backend
+from .persistence import (
+    WriteAheadLog, dump_binary_snapshot, is_binary_snapshot,
+    load_binary_snapshot, replace_file
+)
+
+# Module-level logger
+log = logging.getLogger(__name__)
+
+# Collection properties that are part of the store but not of the Collection resource.
+# In memory, objects and manifest entries live in the indexes, not in the collection.
+STORE_ONLY_FIELDS = ("manifest", "responses", "objects", "retention")
+
+# Internal properties stored alongside objects that must never be returned to clients
+HIDDEN_FIELDS = ("_date_added",)
+
+
+class ManifestRecord(object):
+    """Compact in-memory manifest entry.
+
+    Uses ``__slots__`` instead of a dict and shares its strings: ids and
+    versions with the stored object, media types and date_added values with
+    every other entry through interning. date_added is also kept as integer
+    microseconds for ordering. Supports the read-only mapping access the
+    filters use (``man["id"]``, ``"version" in man``) and is turned into a
+    dict by ``to_dict`` only when returned to a client or written to a file.
+    """
+
+    __slots__ = ("id", "date_added", "version", "media_type", "date_added_us")
+
+    FIELDS = ("id", "date_added", "version", "media_type")
+
+    def __init__(self, id, date_added, version, media_type):
+        self.id = sys.intern(id)
+        self.date_added = sys.intern(date_added)
+        self.version = sys.intern(version)
+        self.media_type = sys.intern(media_type)
+        self.date_added_us = string_to_micros(date_added)
+
+    @classmethod
+    def from_dict(cls, man):
+        return cls(man["id"], man["date_added"], man["version"], man["media_type"])
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def __eq__(self, other):
+        return isinstance(other, ManifestRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return "ManifestRecord({!r})".format(self.to_dict())
 
 
 def remove_hidden_field(objs):
-    for obj in objs:
-        if "_date_added" in obj:
-            del obj["_date_added"]
+    """Return shallow copies of ``objs`` without internal properties. Stored
+    objects are shared between requests, so only the returned page is copied."""
+    return [{k: v for k, v in obj.items() if k not in HIDDEN_FIELDS} for obj in objs]
 
 
-def find_headers(headers, manifest, obj):
-    obj_time = find_att(obj)
-    for man in manifest:
-        if man["id"] == obj["id"] and obj_time == find_att(man):
-            if len(headers) == 0:
-                headers["X-TAXII-Date-Added-First"] = man["date_added"]
-            else:
-                headers["X-TAXII-Date-Added-Last"] = man["date_added"]
+def index_objects(objects):
+    """Build an ``id -> {version: object}`` index over a list of STIX objects.
+    Ids are interned so they are shared with the objects' manifest records."""
+    index = {}
+    for obj in objects:
+        obj["id"] = sys.intern(obj["id"])
+        index.setdefault(obj["id"], {})[find_att(obj)] = obj
+    return index
+
+
+def index_date_added(manifest):
+    """Build the date_added-ordered index over a list of manifest entries: a
+    sorted list of ``(date_added in microseconds, id, version)`` keys."""
+    return sorted(date_added_key(man) for man in manifest)
+
+
+def stix_type(obj_id):
+    return obj_id.partition("--")[0]
+
+
+def index_types(objects):
+    """Build the inverted ``type -> set of ids`` index over an object index.
+    The type of an object is the prefix of its id."""
+    index = {}
+    for obj_id in objects:
+        index.setdefault(stix_type(obj_id), set()).add(obj_id)
+    return index
+
+
+def index_orphans(objects, manifest):
+    """Build an ``id -> set of versions`` index of the manifest entries that have
+    no stored object. They are listed by the manifest, but not among the objects."""
+    index = {}
+    for obj_id, version in manifest:
+        if version not in objects.get(obj_id, ()):
+            index.setdefault(obj_id, set()).add(version)
+    return index
+
+
+def count(counter, key, delta):
+    """Add ``delta`` to ``counter[key]``, dropping keys that reach zero."""
+    n = counter.get(key, 0) + delta
+    if n:
+        counter[key] = n
+    else:
+        counter.pop(key, None)
+
+
+def collection_statistics(objects, manifest):
+    """Compute the counters kept for a collection from its object index and
+    manifest index. They are then maintained on every add and delete."""
+    stats = {"objects": len(objects), "versions": len(manifest), "types": {}, "media_types": {}}
+    for obj_id in objects:
+        count(stats["types"], stix_type(obj_id), 1)
+    for man in manifest.values():
+        count(stats["media_types"], man.media_type, 1)
+    return stats
+
+
+def date_added_key(man):
+    return man.date_added_us, man.id, find_att(man)
+
+
+def collection_metadata(collection):
+    """Return a copy of the collection resource without the stored objects and manifest."""
+    return copy.deepcopy({k: v for k, v in collection.items() if k not in STORE_ONLY_FIELDS})
+
+
+def reads(method):
+    """Run ``method`` holding the backend lock in shared mode."""
+
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock.read_locked():
+            return method(self, *args, **kwargs)
+
+    return locked
+
+
+def writes(method):
+    """Run ``method`` holding the backend lock in exclusive mode."""
+
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self._lock.write_locked():
+            return method(self, *args, **kwargs)
+
+    return locked
 
 
 class MemoryBackend(Backend):
 
     # access control is handled at the views level
 
+    # Concurrency: requests that only read the store run in parallel under the
+    # shared side of self._lock, writes take it exclusively. Paging sessions
+    # are written by readers too, so they have their own self._session_lock.
+    # Only public methods acquire the locks; private helpers assume the caller holds them.
+
+    # Persistence: when "wal_filename" is configured every add_objects and
+    # delete_object is appended to a write-ahead log before it is applied. The
+    # log is compacted every "snapshot_interval" seconds by writing the whole
+    # store to "snapshot_filename" (by default the "filename" the store was
+    # loaded from, followed by ".snapshot" for binary snapshots) and emptying
+    # the log. On start-up the latest snapshot is
+    # loaded and the log replayed on top of it.
+    #
+    # Snapshots are JSON, or with "snapshot_format": "binary" a pickle of the
+    # data together with the prebuilt indexes named in INDEXES, which loads
+    # without re-parsing or re-indexing. "snapshot_on_exit" writes a snapshot
+    # when the interpreter shuts down.
+
+    # Attributes built by _build_indexes and stored in binary snapshots.
+    # SNAPSHOT_VERSION must change whenever their layout does.
+    INDEXES = ("collection_lookup", "object_index", "manifest_index", "date_index", "type_index", "collection_stats")
+    SNAPSHOT_VERSION = 5
+
     def __init__(self, **kwargs):
-        if kwargs.get("filename"):
+        self._lock = ReadWriteLock()
+        self._session_lock = threading.Lock()
+        self._snapshot_lock = threading.Lock()
+        self._wal = None
+        self.filter_engine = None
+        if kwargs.get("filter_engine", "basic") == "numpy":
+            from ..filters.columnar_filter import ColumnarFilter
+            self.filter_engine = ColumnarFilter
+        self.columnar_threshold = kwargs.get("columnar_threshold", 10000)
+        self._columnar_lock = threading.Lock()
+        self.filter_cache_size = kwargs.get("filter_cache_size", 256)
+        self.parallel_workers = kwargs.get("parallel_workers", 0)
+        self.parallel_threshold = kwargs.get("parallel_threshold", 100000)
+        self._shard_workers = None
+        self._workers_lock = threading.Lock()
+        self.snapshot_format = kwargs.get("snapshot_format", "json")
+        if self.snapshot_format not in ("json", "binary"):
+            raise ValueError("Unknown snapshot_format '{}'".format(self.snapshot_format))
+        self.snapshot_filename = self._snapshot_filename(kwargs.get("filename"), kwargs.get("snapshot_filename"))
+        # the pruner is started by the first load of a collection with a retention policy
+        self.retention_batch = kwargs.get("retention_batch", 100)
+        self.retention_interval = kwargs.get("retention_interval", 60)
+        self._pruner = None
+        if isinstance(self.snapshot_filename, string_types) and os.path.exists(self.snapshot_filename):
+            self.load_snapshot(self.snapshot_filename)
+        elif kwargs.get("filename"):
             self.load_data_from_file(kwargs.get("filename"))
         else:
             self.data = {}
+            self._build_indexes()
         self.next = {}
         self.timeout = kwargs.get("session_timeout", 30)
 
         checker = SessionChecker(kwargs.get("check_interval", 10), self._pop_expired_sessions)
         checker.start()
 
-    def set_next(self, objects, args):
-        u = str(uuid.uuid4())
-        if "limit" in args:
-            del args["limit"]
-        for arg in args:
-            new_list = args[arg].split(',')
-            new_list.sort()
-            args[arg] = new_list
-        d = {"objects": objects, "args": args, "request_time": datetime_to_float(get_timestamp())}
-        self.next[u] = d
-        return u
+        if kwargs.get("wal_filename"):
+            self._open_wal(kwargs["wal_filename"], kwargs.get("wal_sync", True))
+            compactor = SessionChecker(kwargs.get("snapshot_interval", 300), self._compact_wal)
+            compactor.start()
 
-    def get_next(self, filter_args, allowed, manifest, lim):
-        n = filter_args["next"]
-        if n in self.next:
-            for arg in filter_args:
-                new_list = filter_args[arg].split(',')
-                new_list.sort()
-                filter_args[arg] = new_list
-            del filter_args["next"]
-            del filter_args["limit"]
-            if filter_args != self.next[n]["args"]:
-                raise ProcessingError("The server did not understand the request or filter parameters: params changed over subsequent transaction", 400)
-            t = self.next[n]["objects"]
-            length = len(self.next[n]["objects"])
-            headers = {}
-            ret = []
-            if length <= lim:
-                limit = length
-                more = False
-                nex = None
-            else:
-                limit = lim
-                more = True
-
-            for i in range(0, limit):
-                x = t.pop(0)
-                ret.append(x)
-                if len(headers) == 0:
-                    find_headers(headers, manifest, x)
-                if i == limit - 1:
-                    find_headers(headers, manifest, x)
-            if not more:
-                self.next.pop(n)
+        if kwargs.get("snapshot_on_exit"):
+            atexit.register(self.snapshot)
+
+    def _snapshot_filename(self, filename, snapshot_filename):
+        """Return where snapshots are written. JSON snapshots go to the data file
+        by default; binary ones go next to it, so that the data file is never
+        replaced by a pickle."""
+        if self.snapshot_format == "json":
+            return snapshot_filename or filename
+        if snapshot_filename is None:
+            return filename + ".snapshot" if isinstance(filename, string_types) else None
+        if snapshot_filename == filename:
+            raise ValueError("Binary snapshots cannot be written to the data file '{}'; set another snapshot_filename.".format(filename))
+        return snapshot_filename
+
+    def _open_wal(self, wal_filename, sync):
+        if not self.snapshot_filename:
+            raise ValueError("A write-ahead log requires a filename or snapshot_filename to compact into.")
+        self._wal = WriteAheadLog(wal_filename, sync)
+        replayed = 0
+        for record in self._wal.replay():
+            self._replay(record)
+            replayed += 1
+        self._wal.trim()
+        self._wal.count = replayed
+        if replayed:
+            log.info("Replayed {} operations from {}".format(replayed, wal_filename))
+
+    def _log_operation(self, record):
+        if self._wal is not None:
+            self._wal.append(record)
+
+    def _replay(self, record):
+        """Re-apply a logged operation. Replay is idempotent, as a crash after
+        a snapshot was written but before the log was emptied replays
+        operations the snapshot already contains."""
+        api_root, collection_id = record["api_root"], record["collection_id"]
+        if record["op"] == "add":
+            index = self.object_index.get((api_root, collection_id), {})
+            objects = [obj for obj in record["objects"] if find_att(obj) not in index.get(obj["id"], {})]
+            status = record["status"]
+            if any(s["id"] == status["id"] for s in self.data[api_root]["status"]):
+                status = None
+            self._apply_add(api_root, collection_id, objects, string_to_datetime(record["request_time"]), status)
+        elif record["op"] == "delete":
+            versions = [string_to_datetime(v) for v in record["versions"]]
+            self._apply_delete(api_root, collection_id, record["id"], versions)
+
+    def _start_pruner(self):
+        if self._pruner is None and any(collection.get("retention") for collection in self.collection_lookup.values()):
+            self._pruner = SessionChecker(self.retention_interval, self.prune)
+            self._pruner.start()
+
+    def prune(self):
+        """Apply the retention policy of every collection that has one. Returns
+        the number of object versions removed."""
+        removed = 0
+        for (api_root, collection_id), collection in list(self.collection_lookup.items()):
+            if collection.get("retention"):
+                removed += self._prune_collection(api_root, collection_id, collection["retention"])
+        return removed
+
+    def _prune_collection(self, api_root, collection_id, policy):
+        """Delete the versions the policy expires. They are found holding the lock
+        in shared mode, then deleted (and logged) in batches of ``retention_batch``
+        objects, releasing the lock between batches so requests are not held up."""
+        with self._lock.read_locked():
+            expired = self._expired_versions(api_root, collection_id, policy)
+        removed = 0
+        for start in range(0, len(expired), self.retention_batch):
+            with self._lock.write_locked():
+                index = self.object_index[(api_root, collection_id)]
+                for obj_id, versions in expired[start:start + self.retention_batch]:
+                    # skip versions deleted since they were found
+                    versions = [version for version in versions if version in index.get(obj_id, ())]
+                    if versions:
+                        self._log_operation({
+                            "op": "delete",
+                            "api_root": api_root,
+                            "collection_id": collection_id,
+                            "id": obj_id,
+                            "versions": [datetime_to_string(version) for version in versions],
+                        })
+                        self._apply_delete(api_root, collection_id, obj_id, versions)
+                        removed += len(versions)
+        if removed:
+            log.info("Pruned {} object versions from collection {}".format(removed, collection_id))
+        return removed
+
+    def _expired_versions(self, api_root, collection_id, policy):
+        """List the ``(id, versions)`` a retention policy expires: versions added
+        more than "max_age" seconds ago, and all but the "max_versions" latest
+        versions of each object. Only the objects given a version over the
+        limit since the last call are looked at, unless the limit changed."""
+        key = (api_root, collection_id)
+        expired = {}
+        max_age = policy.get("max_age")
+        if max_age is not None:
+            cutoff = datetime_to_micros(get_timestamp()) - int(max_age * 1000000)
+            for date_added, obj_id, version in self.date_index[key]:
+                if date_added >= cutoff:
+                    break
+                expired.setdefault(obj_id, set()).add(version)
+        max_versions = policy.get("max_versions")
+        if max_versions is None:
+            self.versions_checked.pop(key, None)
+        else:
+            index = self.object_index[key]
+            candidates = self.over_max_versions.pop(key, set())
+            if self.versions_checked.get(key) != max_versions:
+                candidates = index
+                self.versions_checked[key] = max_versions
+            for obj_id in candidates:
+                versions = index.get(obj_id, {})
+                if len(versions) > max_versions:
+                    expired.setdefault(obj_id, set()).update(sorted(versions)[:len(versions) - max_versions])
+        return [(obj_id, sorted(versions)) for obj_id, versions in sorted(expired.items())]
+
+    def _compact_wal(self):
+        if self._wal is not None and self._wal.count:
+            self.snapshot()
+
+    def snapshot(self, filename=None):
+        """Write the whole store to ``filename`` (by default the snapshot file) in
+        the configured snapshot format. Writing the default snapshot file also
+        empties the write-ahead log of the operations it captured. The store is
+        copied holding the lock in shared mode, and serialized after releasing
+        it, so that neither readers nor writers wait for the file to be written."""
+        with self._snapshot_lock:
+            with self._lock.read_locked():
+                state = self._copy_state()
+                wal_offset = self._wal.tell() if self._wal is not None else None
+            if self.snapshot_format == "binary":
+                replace_file(filename or self.snapshot_filename, lambda outfile: self._dump_binary_snapshot(state, outfile))
             else:
-                nex = n
+                replace_file(
+                    filename or self.snapshot_filename,
+                    lambda outfile: outfile.write(json.dumps(self._export_data(state)).encode("utf-8")),
+                )
+            if self._wal is not None and filename in (None, self.snapshot_filename):
+                with self._lock.write_locked():
+                    self._wal.discard(wal_offset)
+
+    def _state(self):
+        """Return ``self.data`` and the indexes named in INDEXES, by name."""
+        state = {name: getattr(self, name) for name in self.INDEXES}
+        state["data"] = self.data
+        return state
 
-            return ret, more, headers, nex
+    def _copy_state(self):
+        """Return a copy of ``_state`` that later writes leave alone. Only the
+        containers are copied, as stored objects and manifest entries are never
+        modified in place. Must be called holding the lock."""
+        memo = {}
+        return {
+            # the collections are shared by both, and stay so in the copy
+            "data": copy.deepcopy(self.data, memo),
+            "collection_lookup": copy.deepcopy(self.collection_lookup, memo),
+            "object_index": {
+                key: {obj_id: dict(versions) for obj_id, versions in index.items()}
+                for key, index in self.object_index.items()
+            },
+            "manifest_index": {key: dict(index) for key, index in self.manifest_index.items()},
+            "date_index": {key: list(index) for key, index in self.date_index.items()},
+            "type_index": {
+                key: {obj_type: set(ids) for obj_type, ids in index.items()}
+                for key, index in self.type_index.items()
+            },
+            "collection_stats": copy.deepcopy(self.collection_stats),
+        }
+
+    def _dump_binary_snapshot(self, state, outfile):
+        state = dict(state, version=self.SNAPSHOT_VERSION)
+        dump_binary_snapshot(state, outfile)
+
+    @writes
+    def load_snapshot(self, filename):
+        """Load a snapshot written by ``snapshot``, in either format."""
+        state = self._read_binary_snapshot(filename)
+        if state is None:
+            self._load_json(filename)
+        elif state.get("version") == self.SNAPSHOT_VERSION:
+            self.data = state["data"]
+            for name in self.INDEXES:
+                setattr(self, name, state[name])
+            self._reset_caches()
         else:
+            log.warning("Snapshot {} was written by another version, rebuilding its indexes".format(filename))
+            self.data = self._restore_collections(state)
+            self._build_indexes()
+        self._start_pruner()
+
+    def _read_binary_snapshot(self, filename):
+        """Return the state held by a binary snapshot, or None if ``filename``
+        holds a JSON one."""
+        if not is_binary_snapshot(filename):
+            return None
+        with io.open(filename, "rb") as infile:
+            return load_binary_snapshot(infile)
+
+    def _restore_collections(self, state):
+        """Return the data of a binary snapshot ``state`` written by another
+        version, with the objects and manifest of every collection put back in
+        place from its object and manifest indexes, which all versions store."""
+        for key, collection in state["collection_lookup"].items():
+            collection["objects"] = [obj for versions in state["object_index"][key].values() for obj in versions.values()]
+            collection["manifest"] = [
+                {field: man[field] for field in ManifestRecord.FIELDS} for man in state["manifest_index"][key].values()
+            ]
+        return state["data"]
+
+    def set_next(self, filter_args, cursor):
+        """Record a paging session. Only the normalized filter and the sort key
+        of the last result served are kept, so later pages are recomputed and
+        the session size does not depend on the size of the result set."""
+        u = filter_args.get("next") or str(uuid.uuid4())
+        record = {
+            "cursor": cursor,
+            "args": parse_request_parameters(filter_args),
+            "request_time": datetime_to_float(get_timestamp()),
+        }
+        with self._session_lock:
+            self.next[u] = record
+        return u
+
+    def get_next(self, filter_args):
+        """Return the cursor of the paging session named by the ``next``
+        parameter, or None if the request does not continue a session."""
+        n = filter_args.get("next")
+        if n is None:
+            return None
+        with self._session_lock:
+            record = self.next.get(n)
+        if record is None:
             raise ProcessingError("The server did not understand the request or filter parameters: 'next' not valid", 400)
+        if parse_request_parameters(filter_args) != record["args"]:
+            raise ProcessingError("The server did not understand the request or filter parameters: params changed over subsequent transaction", 400)
+        return record["cursor"]
+
+    def _update_session(self, filter_args, page, next_save, manifest=None):
+        """Advance or close the paging session after ``page`` was computed.
+        Returns the ``more`` flag and the ``next`` id of the response."""
+        if next_save:
+            return True, self.set_next(filter_args, pagination_key(page[-1], manifest))
+        if "next" in filter_args:
+            with self._session_lock:
+                self.next.pop(filter_args["next"], None)
+        return False, None
 
     def _pop_expired_sessions(self):
         expired_ids = []
         boundary = datetime_to_float(get_timestamp())
-        for next_id, record in self.next.items():
-            if boundary - record["request_time"] > self.timeout:
-                expired_ids.append(next_id)
+        with self._session_lock:
+            for next_id, record in self.next.items():
+                if boundary - record["request_time"] > self.timeout:
+                    expired_ids.append(next_id)
 
-        for item in expired_ids:
-            self.next.pop(item)
+            for item in expired_ids:
+                self.next.pop(item)
 
+    @writes
     def load_data_from_file(self, filename):
+        self._load_json(filename)
+        self._start_pruner()
+
+    def _load_json(self, filename):
         if isinstance(filename, string_types):
             with io.open(filename, "r", encoding="utf-8") as infile:
                 self.data = json.load(infile)
         else:
             self.data = json.load(filename)
+        self._build_indexes()
+
+    def _build_indexes(self):
+        """Rebuild the collection lookup table and the per-collection object,
+        manifest, date_added and type indexes from ``self.data``. Must be called
+        whenever ``self.data`` is replaced. The objects and manifest of each
+        collection are moved out of ``self.data`` into the indexes, see ``_export_data``."""
+        self.collection_lookup = {}
+        self.object_index = {}
+        self.manifest_index = {}
+        self.date_index = {}
+        self.type_index = {}
+        self.collection_stats = {}
+        for api_root, api_info in self.data.items():
+            if not isinstance(api_info, dict):
+                continue
+            for collection in api_info.get("collections", []):
+                key = (api_root, collection["id"])
+                manifest = [ManifestRecord.from_dict(man) for man in collection.pop("manifest", [])]
+                self.collection_lookup[key] = collection
+                self.object_index[key] = index_objects(collection.pop("objects", []))
+                self.manifest_index[key] = index_manifest(manifest)
+                self.date_index[key] = index_date_added(manifest)
+                self.type_index[key] = index_types(self.object_index[key])
+                self.collection_stats[key] = collection_statistics(self.object_index[key], self.manifest_index[key])
+        self._reset_caches()
+
+    def _reset_caches(self):
+        """Drop everything derived from the store that is not an index."""
+        # (api_root, collection_id) -> {(id, version): JSON text of the object}
+        self.json_cache = {}
+        # (api_root, collection_id) -> ColumnarIndex, updated by every write
+        self.columnar_index = {}
+        # (api_root, collection_id) -> thread building its ColumnarIndex, and the
+        # changes to the collection to apply to the index once it is built
+        self._columnar_builds = {}
+        self._columnar_changes = {}
+        # (api_root, collection_id) -> ids of the objects given a version over the
+        # "max_versions" of the collection's retention policy, and the limit all
+        # objects were last checked against, see _expired_versions
+        self.over_max_versions = {}
+        self.versions_checked = {}
+        # (api_root, collection_id) -> number of writes to the collection, part
+        # of the filter cache keys so that a write invalidates the cached results
+        self.generation = {}
+        # the shards held by the ParallelFilter workers are rebuilt on their next request
+        if self._shard_workers is not None:
+            self._shard_workers.reset()
+        # (api_root, collection_id) -> {id: versions} of the manifest entries without
+        # a stored object. Only loaded data has them, and a write never adds one.
+        self.orphan_index = {
+            key: index_orphans(self.object_index[key], manifest) for key, manifest in self.manifest_index.items()
+        }
+        # cache key -> pagination keys of the page and of the next result
+        self.filter_cache = LRUCache(self.filter_cache_size) if self.filter_cache_size else None
+
+    def _invalidate(self, api_root, collection_id):
+        """Discard what was derived from the content of a collection before a write."""
+        key = (api_root, collection_id)
+        self.generation[key] = self.generation.get(key, 0) + 1
+
+    def _columnar_index(self, api_root, collection_id):
+        """Return the ColumnarIndex of the collection, or None when the numpy
+        filter engine is off, the collection is too small for it to pay off, or
+        its index is not built yet. The index is built in the background on the
+        first request that could use it, and requests are served by the other
+        filter paths meanwhile."""
+        key = (api_root, collection_id)
+        if self.filter_engine is None or self.collection_stats[key]["versions"] < self.columnar_threshold:
+            return None
+        columns = self.columnar_index.get(key)
+        if columns is None:
+            with self._columnar_lock:
+                if key not in self._columnar_builds:
+                    builder = threading.Thread(
+                        target=self._build_columnar_index,
+                        args=(key, self.columnar_index, self._columnar_builds, self._columnar_changes),
+                    )
+                    builder.daemon = True
+                    self._columnar_builds[key] = builder
+                    builder.start()
+        return columns
+
+    def _build_columnar_index(self, key, indexes, builds, changes):
+        """Build the ColumnarIndex of a collection into ``indexes``. The manifest is
+        copied holding the lock in shared mode, and the index built after
+        releasing it. The writes made meanwhile are recorded in ``changes``, and
+        applied to the index when it is put in place. These dicts belong to the
+        store being indexed, so an index of a store replaced meanwhile is never used."""
+        try:
+            with self._lock.read_locked():
+                objects = self.object_index[key]
+                manifest = list(self.manifest_index[key].items())
+                changes[key] = []
+            # an object written since the copy gets its row right from the changes
+            rows = (
+                (obj_id, version, man, objects.get(obj_id, {}).get(version))
+                for (obj_id, version), man in manifest
+            )
+            columns = self.filter_engine.build_index(rows)
+            with self._lock.write_locked():
+                for added, removed in changes.pop(key):
+                    columns.update(added, removed)
+                indexes[key] = columns
+        except Exception:
+            log.exception("Failed to build the columnar index of collection {}".format(key[1]))
+            with self._lock.write_locked():
+                changes.pop(key, None)
+        finally:
+            with self._columnar_lock:
+                builds.pop(key, None)
+
+    def _serialize(self, api_root, collection_id, objs):
+        """Return the JSON text of each stored object in ``objs``. Object versions
+        are immutable, so each one is encoded once, on its first read, and kept
+        until it is deleted."""
+        cache = self.json_cache.setdefault((api_root, collection_id), {})
+        fragments = []
+        for obj in objs:
+            key = (obj["id"], find_att(obj))
+            fragment = cache.get(key)
+            if fragment is None:
+                fragment = cache[key] = json.dumps(remove_hidden_field([obj])[0], sort_keys=True)
+            fragments.append(fragment)
+        return fragments
+
+    def _export_data(self, state=None):
+        """Return the store (or a ``state`` of it, see ``_state``) in the layout of
+        ``self.data`` files, with the objects and manifest of every collection
+        put back in place."""
+        state = state or self._state()
+        data = {}
+        for api_root, api_info in state["data"].items():
+            if isinstance(api_info, dict) and "collections" in api_info:
+                api_info = dict(api_info)
+                api_info["collections"] = [
+                    self._export_collection(state, api_root, collection) for collection in api_info["collections"]
+                ]
+            data[api_root] = api_info
+        return data
+
+    def _export_collection(self, state, api_root, collection):
+        key = (api_root, collection["id"])
+        manifest = state["manifest_index"][key]
+        collection = dict(collection)
+        collection["objects"] = [obj for versions in state["object_index"][key].values() for obj in versions.values()]
+        collection["manifest"] = [manifest[entry[1:]].to_dict() for entry in state["date_index"][key]]
+        return collection
+
+    def _get_collection(self, api_root, collection_id):
+        return self.collection_lookup.get((api_root, collection_id))
+
+    def _rows(self, api_root, collection_id, manifest_rows):
+        """Return how to fetch a collection's entries: ``entry(id, version)``, None
+        if there is no such entry, ``versions_of(id)``, all the entries of an
+        object, and the manifest to pass to BasicFilter with them. Entries are
+        the stored objects or, with ``manifest_rows``, the manifest entries,
+        which include those of objects that are not stored."""
+        key = (api_root, collection_id)
+        index = self.object_index[key]
+        manifest = self.manifest_index[key]
+        if manifest_rows:
+            orphans = self.orphan_index.get(key, {})
+
+            def entry(obj_id, version):
+                return manifest.get((obj_id, version))
+
+            def versions_of(obj_id):
+                versions = itertools.chain(index.get(obj_id, ()), orphans.get(obj_id, ()))
+                return [manifest[(obj_id, version)] for version in versions if (obj_id, version) in manifest]
+            return entry, versions_of, None
+
+        def entry(obj_id, version):
+            return index.get(obj_id, {}).get(version)
+
+        def versions_of(obj_id):
+            return list(index.get(obj_id, {}).values())
+        return entry, versions_of, manifest
+
+    def _filter_collection(self, api_root, collection_id, filter_args, allowed_filters, limit, manifest_rows=False):
+        """Apply a request to the objects (or with ``manifest_rows``, the manifest
+        entries) of a collection. Returns the page, the remaining results (at
+        least the next one, if any) and the headers.
+
+        Results are cached by request (filters, page size and paging cursor)
+        and by generation of the collection, so that a repeated poll is served
+        from the cache until the collection changes."""
+        after = self.get_next(filter_args)
+        if self.filter_cache is None:
+            return self._run_filter(api_root, collection_id, filter_args, allowed_filters, limit, after, manifest_rows)
+
+        manifest_info = self._rows(api_root, collection_id, manifest_rows)[2]
+        cache_key = (
+            api_root, collection_id, manifest_rows, tuple(sorted(allowed_filters)),
+            tuple(sorted((k, v) for k, v in filter_args.items() if k != "limit" and k != "next")),
+            limit, after, self.generation.get((api_root, collection_id), 0),
+        )
+        cached = self.filter_cache.get(cache_key)
+        if cached is None:
+            new, next_save, headers = self._run_filter(api_root, collection_id, filter_args, allowed_filters, limit, after, manifest_rows)
+            # only the pagination keys are kept, and of the remaining results only the next one
+            self.filter_cache.put(cache_key, (
+                [pagination_key(result, manifest_info) for result in new],
+                [pagination_key(result, manifest_info) for result in next_save[:1]],
+            ))
+            return new, next_save, headers
+        return self._page_from_keys(api_root, collection_id, cached[0], cached[1], manifest_rows)
+
+    def _page_from_keys(self, api_root, collection_id, page, next_page, manifest_rows):
+        """Turn the pagination keys of a page and of the next result into the
+        page, remaining results and headers returned by ``_filter_collection``."""
+        entry = self._rows(api_root, collection_id, manifest_rows)[0]
+        new = [entry(obj_id, version) for _, obj_id, version in page]
+        next_save = [entry(obj_id, version) for _, obj_id, version in next_page]
+        headers = {}
+        if page:
+            manifest = self.manifest_index[(api_root, collection_id)]
+            headers["X-TAXII-Date-Added-First"] = manifest[page[0][1:]]["date_added"]
+            headers["X-TAXII-Date-Added-Last"] = manifest[page[-1][1:]]["date_added"]
+        return new, next_save, headers
+
+    def _run_filter(self, api_root, collection_id, filter_args, allowed_filters, limit, after, manifest_rows):
+        entry, versions_of, manifest_info = self._rows(api_root, collection_id, manifest_rows)
+
+        full_filter = BasicFilter(filter_args)
+        # a page the date_added scan below fills quickly is not worth a pass over the whole collection
+        if not self._stops_early(api_root, collection_id, filter_args, allowed_filters, limit):
+            candidates = self._type_candidates(api_root, collection_id, filter_args, allowed_filters, manifest_rows)
+            if candidates is not None:
+                entries = [found for obj_id in candidates for found in versions_of(obj_id)]
+                return full_filter.process_filter(entries, allowed_filters, manifest_info, limit, after)
+
+            columns = self._columnar_index(api_root, collection_id)
+            if columns is not None:
+                rows = columns.manifest if manifest_rows else columns.objects
+                return self.filter_engine(filter_args, columns).process_filter(
+                    rows, allowed_filters, None, limit, after, stored_only=not manifest_rows,
+                )
+
+            workers = self._filter_workers(api_root, collection_id)
+            if workers is not None:
+                parallel_filter = ParallelFilter(filter_args, workers)
+                page, next_page = parallel_filter.process_shards(
+                    (api_root, collection_id), allowed_filters, limit, after, stored_only=not manifest_rows,
+                )
+                return self._page_from_keys(api_root, collection_id, page, next_page, manifest_rows)
+
+        # date_added order is the pagination order: stop once the page is full.
+        # The index lists every manifest entry, some of which may have no object.
+        entries = (
+            entry(obj_id, version)
+            for obj_id, version in self._added_after(api_root, collection_id, filter_args.get("added_after"), after)
+        )
+        source = (found for found in entries if found is not None)
+        matches = full_filter.filter_lazily(source, versions_of, allowed_filters, manifest_info)
+        return full_filter.paginate_lazily(matches, limit, manifest_info)
+
+    def _stops_early(self, api_root, collection_id, filter_args, allowed_filters, limit):
+        """Tell whether the date_added scan at the end of ``_run_filter`` is expected
+        to fill the page after reading at most a hundredth of the collection,
+        which beats any pass over all of it. The share of the collection the
+        request matches is estimated from its counters, taking the filters to be
+        independent."""
+        if not limit:
+            return False
+        stats = self.collection_stats[(api_root, collection_id)]
+        if not stats["objects"] or not stats["versions"]:
+            # the scan has nothing to read: objects not in the manifest are never served
+            return True
+        share = 1.0
+        match_id = filter_args.get("match[id]")
+        if match_id and "id" in allowed_filters:
+            share *= len(set(match_id.split(","))) / stats["objects"]
+        match_type = filter_args.get("match[type]")
+        if match_type and "type" in allowed_filters:
+            share *= sum(stats["types"].get(type_, 0) for type_ in set(match_type.split(","))) / stats["objects"]
+        match_spec_version = filter_args.get("match[spec_version]")
+        if match_spec_version and "spec_version" in allowed_filters:
+            media_types = {"application/stix+json;version={}".format(spec) for spec in match_spec_version.split(",")}
+            share *= sum(stats["media_types"].get(media_type, 0) for media_type in media_types) / stats["versions"]
+        versions = (filter_args.get("match[version]") or "last").split(",")
+        if "version" in allowed_filters and not {"first", "last", "all"}.intersection(versions):
+            # at most one version of each object
+            share *= stats["objects"] / stats["versions"]
+        return share > 0 and (limit + 1) / share * 100 <= stats["versions"]
+
+    def _filter_workers(self, api_root, collection_id):
+        """Return the ShardWorkers of ParallelFilter, in sync with the collection,
+        or None when parallel filtering is off or the collection is too small for
+        it to pay off. The workers are started on first use."""
+        key = (api_root, collection_id)
+        if not self.parallel_workers or self.collection_stats[key]["versions"] < self.parallel_threshold:
+            return None
+        with self._workers_lock:
+            if self._shard_workers is None:
+                self._shard_workers = ShardWorkers(self.parallel_workers)
+        self._shard_workers.sync(key, self.manifest_index[key], self.orphan_index[key])
+        return self._shard_workers
 
+    def close_filter_pool(self):
+        """Stop the worker processes of ParallelFilter, if they were started."""
+        with self._workers_lock:
+            if self._shard_workers is not None:
+                self._shard_workers.close()
+                self._shard_workers = None
+
+    def _record_change(self, api_root, collection_id, added=(), removed=()):
+        """Apply a change to the manifest of a collection to its ColumnarIndex, and
+        record it for the ParallelFilter workers. ``added`` are ``(id, version,
+        manifest entry, object)`` rows and ``removed`` ``(id, version)`` keys."""
+        key = (api_root, collection_id)
+        columns = self.columnar_index.get(key)
+        if columns is not None:
+            columns.update(added, removed)
+        elif key in self._columnar_changes:
+            self._columnar_changes[key].append((added, removed))
+        if self._shard_workers is not None:
+            self._shard_workers.record(key, [((obj_id, version), man) for obj_id, version, man, _ in added], removed)
+
+    def _type_candidates(self, api_root, collection_id, filter_args, allowed_filters, manifest_rows=False):
+        """Return the ids of the objects of the types in match[type], from the type
+        index (and with ``manifest_rows``, the ids of manifest entries without an
+        object). Returns None without match[type], or when those types make up
+        most of the collection and are found faster by scanning it in date_added order."""
+        match_type = filter_args.get("match[type]")
+        if not match_type or "type" not in allowed_filters:
+            return None
+        key = (api_root, collection_id)
+        types = self.type_index[key]
+        match_types = set(match_type.split(","))
+        same_type = [types.get(type_, ()) for type_ in match_types]
+        if sum(len(ids) for ids in same_type) * 2 > len(self.object_index[key]):
+            return None
+        candidates = set().union(*same_type)
+        if manifest_rows:
+            candidates.update(obj_id for obj_id in self.orphan_index[key] if stix_type(obj_id) in match_types)
+        return candidates
+
+    def _added_after(self, api_root, collection_id, added_after, after=None):
+        """Yield the ``(id, version)`` of a collection's entries in date_added
+        order, starting with the first one added after ``added_after`` and
+        sorting after the pagination key ``after`` (if given)."""
+        index = self.date_index[(api_root, collection_id)]
+        start = 0
+        if added_after:
+            start = bisect.bisect_left(index, (string_to_micros(added_after) + 1,))
+        if after is not None:
+            start = max(start, bisect.bisect_right(index, after))
+        for position in range(start, len(index)):
+            yield index[position][1:]
+
+    @reads
     def save_data_to_file(self, filename, **kwargs):
         """The kwargs are passed to ``json.dump()`` if provided."""
         if isinstance(filename, string_types):
             with io.open(filename, "w", encoding="utf-8") as outfile:
-                json.dump(self.data, outfile, **kwargs)
+                json.dump(self._export_data(), outfile, **kwargs)
         else:
-            json.dump(self.data, filename, **kwargs)
-
-    def _get(self, key):
-        for ancestors, item in iterpath(self.data):
-            if key in ancestors:
-                return item
+            json.dump(self._export_data(), filename, **kwargs)
 
+    @reads
     def server_discovery(self):
-        return self._get("/discovery")
+        return self.data.get("/discovery")
 
-    def _update_manifest(self, new_obj, api_root, collection_id, request_time):
-        api_info = self._get(api_root)
-        collections = api_info.get("collections", [])
+    def _update_manifest(self, new_objs, api_root, collection_id, request_time):
+        """Create the manifest entries of a bundle of new objects, given as
+        ``(version key, object)`` pairs. The date_added index and the media types
+        of the collection are updated once for the whole bundle."""
+        collection = self._get_collection(api_root, collection_id)
+        manifest_index = self.manifest_index[(api_root, collection_id)]
+        date_index = self.date_index[(api_root, collection_id)]
+        stats = self.collection_stats[(api_root, collection_id)]
         media_type_fmt = "application/stix+json;version={}"
 
-        for collection in collections:
-            if collection_id == collection["id"]:
-                version = determine_version(new_obj, request_time)
-                request_time = datetime_to_string(request_time)
-                media_type = media_type_fmt.format(determine_spec_version(new_obj))
-
-                # version is a single value now, therefore a new manifest is always created
-                collection["manifest"].append(
-                    {
-                        "id": new_obj["id"],
-                        "date_added": request_time,
-                        "version": version,
-                        "media_type": media_type,
-                    },
-                )
+        date_added = datetime_to_string(request_time)
+        media_types = set()
+        keys = []
+        added = []
+        for version_key, new_obj in new_objs:
+            version = determine_version(new_obj, request_time)
+            media_type = media_type_fmt.format(determine_spec_version(new_obj))
+            media_types.add(media_type)
+
+            # an object listed by the manifest but not stored replaces its entry
+            old = manifest_index.get((new_obj["id"], version_key))
+            if old is not None:
+                del date_index[bisect.bisect_left(date_index, date_added_key(old))]
+                stats["versions"] -= 1
+                count(stats["media_types"], old.media_type, -1)
+
+            # version is a single value now, therefore a new manifest is always created
+            man = ManifestRecord(new_obj["id"], date_added, version, media_type)
+            manifest_index[(man.id, version_key)] = man
+            keys.append((man.date_added_us, man.id, version_key))
+            added.append((man.id, version_key, man, new_obj))
+            stats["versions"] += 1
+            count(stats["media_types"], media_type, 1)
 
-                # if the media type is new, attach it to the collection
-                if media_type not in collection["media_types"]:
-                    collection["media_types"].append(media_type)
+        # entries share their date_added, which is usually later than anything
+        # indexed so far: append them, and only re-sort when they interleave
+        keys.sort()
+        if date_index and keys and keys[0] < date_index[-1]:
+            date_index.extend(keys)
+            date_index.sort()
+        else:
+            date_index.extend(keys)
+        self._record_change(api_root, collection_id, added=added)
 
-                # quit once you have found the collection that needed updating
-                break
+        # if a media type is new, attach it to the collection
+        for media_type in sorted(media_types.difference(collection["media_types"])):
+            collection["media_types"].append(media_type)
 
+    @reads
     def get_collections(self, api_root):
         if api_root not in self.data:
             return None  # must return None so 404 is raised
 
-        api_info = self._get(api_root)
-        collections = copy.deepcopy(api_info.get("collections", []))
-
+        api_info = self.data[api_root]
         # Remove data that is not part of the response.
-        for collection in collections:
-            collection.pop("manifest", None)
-            collection.pop("responses", None)
-            collection.pop("objects", None)
+        collections = [collection_metadata(collection) for collection in api_info.get("collections", [])]
         return create_resource("collections", collections)
 
+    @reads
     def get_collection(self, api_root, collection_id):
-        if api_root not in self.data:
+        collection = self._get_collection(api_root, collection_id)
+        if collection is None:
             return None  # must return None so 404 is raised
 
-        api_info = self._get(api_root)
-        collections = copy.deepcopy(api_info.get("collections", []))
-
-        for collection in collections:
-            if collection_id == collection["id"]:
-                collection.pop("manifest", None)
-                collection.pop("responses", None)
-                collection.pop("objects", None)
-                return collection
+        return collection_metadata(collection)
 
+    @reads
     def get_object_manifest(self, api_root, collection_id, filter_args, allowed_filters, limit):
-        more = False
-        n = None
-        if api_root in self.data:
-            api_info = self._get(api_root)
-            collections = api_info.get("collections", [])
-
-            for collection in collections:
-                if collection_id == collection["id"]:
-                    if "next" in filter_args:
-                        manifest = collection.get("manifest", [])
-                        manifest, more, headers, n = self.get_next(filter_args, allowed_filters, manifest, limit)
-                    else:
-                        manifest = collection.get("manifest", [])
-                        full_filter = BasicFilter(filter_args)
-                        manifest, next_save, headers = full_filter.process_filter(
-                            manifest,
-                            allowed_filters,
-                            None,
-                            limit
-                        )
-                        if len(next_save) != 0:
-                            more = True
-                            n = self.set_next(next_save, filter_args)
-                        break
+        collection = self._get_collection(api_root, collection_id)
+        if collection is not None:
+            manifest, next_save, headers = self._filter_collection(
+                api_root, collection_id, filter_args, allowed_filters, limit, manifest_rows=True,
+            )
+            more, n = self._update_session(filter_args, manifest, next_save)
+            manifest = [man.to_dict() for man in manifest]
             return create_resource("objects", manifest, more, n), headers
 
+    @reads
+    def get_collection_statistics(self, api_root, collection_id):
+        """Return the counters maintained for the collection. The first and last
+        date_added are the ends of the date_added index."""
+        collection = self._get_collection(api_root, collection_id)
+        if collection is not None:
+            key = (api_root, collection_id)
+            stats = self.collection_stats[key]
+            manifest = self.manifest_index[key]
+            date_index = self.date_index[key]
+            return {
+                "objects": stats["objects"],
+                "versions": stats["versions"],
+                "types": dict(stats["types"]),
+                "media_types": dict(stats["media_types"]),
+                "date_added_first": manifest[date_index[0][1:]].date_added if date_index else None,
+                "date_added_last": manifest[date_index[-1][1:]].date_added if date_index else None,
+            }
+
+    @reads
     def get_api_root_information(self, api_root):
         if api_root in self.data:
-            api_info = self._get(api_root)
+            api_info = self.data[api_root]
 
             if "information" in api_info:
                 return api_info["information"]
 
+    @reads
     def get_status(self, api_root, status_id):
         if api_root in self.data:
-            api_info = self._get(api_root)
+            api_info = self.data[api_root]
 
             for status in api_info.get("status", []):
                 if status_id == status["id"]:
                     return status
 
+    @reads
     def get_objects(self, api_root, collection_id, filter_args, allowed_filters, limit):
-        more = False
-        n = None
-        if api_root in self.data:
-            api_info = self._get(api_root)
-            collections = api_info.get("collections", [])
-            objs = []
-            for collection in collections:
-                if collection_id == collection["id"]:
-                    manifest = collection.get("manifest", [])
-                    if "next" in filter_args:
-                        objs, more, headers, n = self.get_next(filter_args, allowed_filters, manifest, limit)
-                    else:
-                        objs = copy.deepcopy(collection.get("objects", []))
-                        full_filter = BasicFilter(filter_args)
-                        objs, next_save, headers = full_filter.process_filter(
-                            objs,
-                            allowed_filters,
-                            manifest,
-                            limit
-                        )
-
-                        if len(next_save) != 0:
-                            more = True
-                            n = self.set_next(next_save, filter_args)
-                        break
-            remove_hidden_field(objs)
-            return create_resource("objects", objs, more, n), headers
+        collection = self._get_collection(api_root, collection_id)
+        if collection is not None:
+            manifest = self.manifest_index[(api_root, collection_id)]
+            objs, next_save, headers = self._filter_collection(api_root, collection_id, filter_args, allowed_filters, limit)
+            more, n = self._update_session(filter_args, objs, next_save, manifest)
+            fragments = self._serialize(api_root, collection_id, objs)
+            objs = remove_hidden_field(objs)
+            return SerializedEnvelope(create_resource("objects", objs, more, n), fragments), headers
 
+    @writes
     def add_objects(self, api_root, collection_id, objs, request_time):
         if api_root in self.data:
-            api_info = self._get(api_root)
-            collections = api_info.get("collections", [])
+            collection = self._get_collection(api_root, collection_id)
             failed = 0
             succeeded = 0
             pending = 0
             successes = []
             failures = []
+            accepted = []
 
-            for collection in collections:
-                if collection_id == collection["id"]:
-                    if "objects" not in collection:
-                        collection["objects"] = []
-                    try:
-                        for new_obj in objs["objects"]:
-                            id_and_version_already_present = False
-                            for obj in collection["objects"]:
-                                if new_obj["id"] == obj["id"]:
-                                    if "modified" in new_obj:
-                                        if new_obj["modified"] == obj["modified"]:
-                                            id_and_version_already_present = True
-                                            break
-                                    else:
-                                        # There is no modified field, so this object is immutable
-                                        id_and_version_already_present = True
-                                        break
-                            if id_and_version_already_present is False:
-                                version = determine_version(new_obj, request_time)
-                                if "modified" not in new_obj and "created" not in new_obj:
-                                    new_obj["_date_added"] = version
-                                collection["objects"].append(new_obj)
-                                self._update_manifest(new_obj, api_root, collection["id"], request_time)
-                                status_details = generate_status_details(
-                                    new_obj["id"], version
-                                )
-                                successes.append(status_details)
-                                succeeded += 1
-                            else:
-                                status_details = generate_status_details(
-                                    new_obj["id"], determine_version(new_obj, request_time),
-                                    message="Unable to process object",
-                                )
-                                failures.append(status_details)
-                                failed += 1
-                    except Exception as e:
-                        raise ProcessingError("While processing supplied content, an error occurred", 422, e)
+            if collection is not None:
+                index = self.object_index[(api_root, collection_id)]
+                # versions accepted from this bundle, not yet in the index
+                bundle = {}
+                try:
+                    for new_obj in objs["objects"]:
+                        versions = index.get(new_obj["id"], {})
+                        bundle_versions = bundle.get(new_obj["id"], ())
+                        if "modified" in new_obj:
+                            version_key = find_att(new_obj)
+                            id_and_version_already_present = version_key in versions or version_key in bundle_versions
+                        else:
+                            # There is no modified field, so this object is immutable
+                            id_and_version_already_present = bool(versions) or bool(bundle_versions)
+                        if id_and_version_already_present is False:
+                            version = determine_version(new_obj, request_time)
+                            if "modified" not in new_obj and "created" not in new_obj:
+                                new_obj["_date_added"] = version
+                            bundle.setdefault(new_obj["id"], set()).add(find_att(new_obj))
+                            accepted.append(new_obj)
+                            status_details = generate_status_details(
+                                new_obj["id"], version
+                            )
+                            successes.append(status_details)
+                            succeeded += 1
+                        else:
+                            status_details = generate_status_details(
+                                new_obj["id"], determine_version(new_obj, request_time),
+                                message="Unable to process object",
+                            )
+                            failures.append(status_details)
+                            failed += 1
+                except Exception as e:
+                    raise ProcessingError("While processing supplied content, an error occurred", 422, e)
 
             status = generate_status(
                 datetime_to_string(request_time), "complete", succeeded,
                 failed, pending, successes=successes,
                 failures=failures,
             )
-            api_info["status"].append(status)
+            self._log_operation({
+                "op": "add",
+                "api_root": api_root,
+                "collection_id": collection_id,
+                "objects": accepted,
+                "request_time": datetime_to_string(request_time),
+                "status": status,
+            })
+            self._apply_add(api_root, collection_id, accepted, request_time, status)
             return status
 
+    def _apply_add(self, api_root, collection_id, objects, request_time, status):
+        collection = self._get_collection(api_root, collection_id)
+        if collection is not None:
+            index = self.object_index[(api_root, collection_id)]
+            types = self.type_index[(api_root, collection_id)]
+            stats = self.collection_stats[(api_root, collection_id)]
+            orphans = self.orphan_index[(api_root, collection_id)]
+            max_versions = (collection.get("retention") or {}).get("max_versions")
+            self._invalidate(api_root, collection_id)
+            new_objs = []
+            for new_obj in objects:
+                new_obj["id"] = sys.intern(new_obj["id"])
+                version_key = find_att(new_obj)
+                if version_key in orphans.get(new_obj["id"], ()):
+                    orphans[new_obj["id"]].discard(version_key)
+                    if not orphans[new_obj["id"]]:
+                        del orphans[new_obj["id"]]
+                if new_obj["id"] not in index:
+                    types.setdefault(stix_type(new_obj["id"]), set()).add(new_obj["id"])
+                    stats["objects"] += 1
+                    count(stats["types"], stix_type(new_obj["id"]), 1)
+                index.setdefault(new_obj["id"], {})[version_key] = new_obj
+                if max_versions is not None and len(index[new_obj["id"]]) > max_versions:
+                    self.over_max_versions.setdefault((api_root, collection_id), set()).add(new_obj["id"])
+                new_objs.append((version_key, new_obj))
+            self._update_manifest(new_objs, api_root, collection_id, request_time)
+        if status is not None:
+            self.data[api_root]["status"].append(status)
+
+    @reads
     def get_object(self, api_root, collection_id, object_id, filter_args, allowed_filters, limit):
-        more = False
-        n = None
-        if api_root in self.data:
-            api_info = self._get(api_root)
-            collections = api_info.get("collections", [])
-            objs = []
-            manifests = []
-            for collection in collections:
-                if collection_id == collection["id"]:
-                    manifests = collection.get("manifest", [])
-                    if "next" in filter_args:
-                        objs, more, headers, n = self.get_next(filter_args, allowed_filters, manifests, limit)
-                    else:
-                        for obj in collection.get("objects", []):
-                            if object_id == obj["id"]:
-                                objs.append(obj)
-                        if len(objs) == 0:
-                            raise ProcessingError("Object '{}' not found".format(object_id), 404)
-                        full_filter = BasicFilter(filter_args)
-                        objs, next_save, headers = full_filter.process_filter(
-                            objs,
-                            allowed_filters,
-                            manifests,
-                            limit
-                        )
-                        if len(next_save) != 0:
-                            more = True
-                            n = self.set_next(next_save, filter_args)
-                        break
-            remove_hidden_field(objs)
-            return create_resource("objects", objs, more, n), headers
+        collection = self._get_collection(api_root, collection_id)
+        if collection is not None:
+            manifest = self.manifest_index[(api_root, collection_id)]
+            after = self.get_next(filter_args)
+            versions = self.object_index.get((api_root, collection_id), {}).get(object_id, {})
+            objs = list(versions.values())
+            if len(objs) == 0:
+                raise ProcessingError("Object '{}' not found".format(object_id), 404)
+            full_filter = BasicFilter(filter_args)
+            objs, next_save, headers = full_filter.process_filter(
+                objs,
+                allowed_filters,
+                manifest,
+                limit,
+                after,
+            )
+            more, n = self._update_session(filter_args, objs, next_save, manifest)
+            fragments = self._serialize(api_root, collection_id, objs)
+            objs = remove_hidden_field(objs)
+            return SerializedEnvelope(create_resource("objects", objs, more, n), fragments), headers
 
+    @writes
     def delete_object(self, api_root, collection_id, obj_id, filter_args, allowed_filters):
-        if api_root in self.data:
-            api_info = self._get(api_root)
-            collections = api_info.get("collections", [])
-            objs = []
-            manifests = []
-            for collection in collections:
-                if "id" in collection and collection_id == collection["id"]:
-                    coll = collection.get("objects", [])
-                    for obj in coll:
-                        if obj_id == obj["id"]:
-                            objs.append(obj)
-                    manifests = collection.get("manifest", [])
-                    break
+        collection = self._get_collection(api_root, collection_id)
+        if collection is not None:
+            index = self.object_index[(api_root, collection_id)]
+            objs = list(index.get(obj_id, {}).values())
 
             full_filter = BasicFilter(filter_args)
             objs, nex, headers = full_filter.process_filter(
                 objs,
                 allowed_filters,
-                manifests,
+                self.manifest_index[(api_root, collection_id)],
                 None
             )
 
             if len(objs) == 0:
                 raise ProcessingError("Object '{}' not found".format(obj_id), 404)
 
-            for obj in objs:
-                if obj in coll:
-                    coll.remove(obj)
-                    obj_time = find_att(obj)
-                    for man in manifests:
-                        if obj["id"] == man["id"] and obj_time == find_att(man):
-                            manifests.remove(man)
-                            break
+            versions = [find_att(obj) for obj in objs]
+            self._log_operation({
+                "op": "delete",
+                "api_root": api_root,
+                "collection_id": collection_id,
+                "id": obj_id,
+                "versions": [datetime_to_string(version) for version in versions],
+            })
+            self._apply_delete(api_root, collection_id, obj_id, versions)
+
+    def _apply_delete(self, api_root, collection_id, obj_id, versions):
+        index = self.object_index[(api_root, collection_id)]
+        manifest_index = self.manifest_index[(api_root, collection_id)]
+        json_cache = self.json_cache.get((api_root, collection_id), {})
+        types = self.type_index[(api_root, collection_id)]
+        stats = self.collection_stats[(api_root, collection_id)]
+        self._invalidate(api_root, collection_id)
+        for version in versions:
+            obj = index.get(obj_id, {}).pop(version, None)
+            json_cache.pop((obj_id, version), None)
+            if obj is not None:
+                if not index[obj_id]:
+                    del index[obj_id]
+                    same_type = types[stix_type(obj_id)]
+                    same_type.discard(obj_id)
+                    if not same_type:
+                        del types[stix_type(obj_id)]
+                    stats["objects"] -= 1
+                    count(stats["types"], stix_type(obj_id), -1)
+                man = manifest_index.pop((obj_id, version), None)
+                if man is not None:
+                    self._record_change(api_root, collection_id, removed=[(obj_id, version)])
+                    stats["versions"] -= 1
+                    count(stats["media_types"], man.media_type, -1)
+                    date_index = self.date_index[(api_root, collection_id)]
+                    del date_index[bisect.bisect_left(date_index, date_added_key(man))]
 
+    @reads
     def get_object_versions(self, api_root, collection_id, object_id, filter_args, allowed_filters, limit):
-        more = False
-        n = None
-        if api_root in self.data:
-            api_info = self._get(api_root)
-            collections = api_info.get("collections", [])
-
-            objs = []
-            for collection in collections:
-                if collection_id == collection["id"]:
-                    all_manifests = collection.get("manifest", [])
-                    if "next" in filter_args:
-                        objs, more, headers, n = self.get_next(filter_args, allowed_filters, all_manifests, limit)
-                        objs = sorted(map(lambda x: x["version"], objs), reverse=True)
-                    else:
-
-                        all_manifests = collection.get("manifest", [])
-                        for manifest in all_manifests:
-                            if object_id == manifest["id"]:
-                                objs.append(manifest)
-                        if len(objs) == 0:
-                            raise ProcessingError("Object '{}' not found".format(object_id), 404)
-                        full_filter = BasicFilter(filter_args)
-                        objs, next_save, headers = full_filter.process_filter(
-                            objs,
-                            allowed_filters,
-                            None,
-                            limit
-                        )
-                        if len(next_save) != 0:
-                            more = True
-                            n = self.set_next(next_save, filter_args)
-                        objs = sorted(map(lambda x: x["version"], objs), reverse=True)
-                        break
+        collection = self._get_collection(api_root, collection_id)
+        if collection is not None:
+            manifest = self.manifest_index[(api_root, collection_id)]
+            after = self.get_next(filter_args)
+            versions = self.object_index.get((api_root, collection_id), {}).get(object_id, {})
+            objs = [manifest[(object_id, version)] for version in versions if (object_id, version) in manifest]
+            if len(objs) == 0:
+                raise ProcessingError("Object '{}' not found".format(object_id), 404)
+            full_filter = BasicFilter(filter_args)
+            objs, next_save, headers = full_filter.process_filter(
+                objs,
+                allowed_filters,
+                None,
+                limit,
+                after,
+            )
+            more, n = self._update_session(filter_args, objs, next_save)
+            objs = sorted(map(lambda x: x["version"], objs), reverse=True)
             return create_resource("versions", objs, more, n), headers
@@ -0,0 +1,314 @@
+import gc
+import io
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import sys
+
+# Module-level logger
+log = logging.getLogger(__name__)
+
+# Binary snapshots start with this header, followed by a pickle of the state
+SNAPSHOT_MAGIC = b"MEDALLION-SNAPSHOT\n"
+
+# Mapped snapshots start with this header and the size of the objects region
+# that follows it, as an 8-byte big-endian integer, then a pickle of the state
+MAPPED_SNAPSHOT_MAGIC = b"MEDALLION-MAPPED-SNAPSHOT\n"
+REGION_SIZE = struct.Struct(">Q")
+
+# The properties of a MappedObject kept outside the mapping: those the filters
+# and the version lookup read, so that filtering does not decode objects
+MAPPED_FIELDS = ("id", "type", "spec_version", "version", "modified", "created", "_date_added", "media_type", "date_added")
+MAPPED_FIELD_INDEX = {name: i for i, name in enumerate(MAPPED_FIELDS)}
+
+
+def replace_file(filename, write):
+    """Atomically replace ``filename``: ``write`` is called with a file object
+    opened on a temporary file, which is moved into place once it is complete."""
+    tmp_filename = filename + ".tmp"
+    with io.open(tmp_filename, "wb") as outfile:
+        write(outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def is_binary_snapshot(filename):
+    """Tell whether ``filename`` holds a binary snapshot (as opposed to JSON)."""
+    with io.open(filename, "rb") as infile:
+        return infile.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def dump_binary_snapshot(state, outfile):
+    """Write ``state`` to the binary file object ``outfile`` as a binary snapshot."""
+    outfile.write(SNAPSHOT_MAGIC)
+    pickle.dump(state, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_binary_snapshot(infile):
+    """Read a binary snapshot written by ``dump_binary_snapshot`` from ``infile``.
+
+    Snapshots are pickles: only load files written by this server.
+    """
+    if infile.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+        raise ValueError("Not a medallion binary snapshot")
+    return load_state(infile)
+
+
+def load_state(infile):
+    """Unpickle a snapshot state from ``infile``. The garbage collector is
+    paused while the (large, acyclic) state is rebuilt, which otherwise
+    dominates the load time."""
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return pickle.load(infile)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+class MappedStore(object):
+    """The objects region of a mapped snapshot, mapped read-only. Every process
+    that maps the same file shares its pages, so the objects are held in memory
+    once however many processes serve them. A MappedStore is pickled without
+    its mapping, which ``load_mapped_snapshot`` opens."""
+
+    def __init__(self):
+        self.map = None
+        self.start = 0
+
+    def __reduce__(self):
+        return MappedStore, ()
+
+    def open(self, infile, start):
+        self.map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.start = start
+
+    def read(self, offset, length):
+        return self.map[self.start + offset:self.start + offset + length]
+
+
+def mapped_fields(obj):
+    """Return the MAPPED_FIELDS of a STIX object, None standing for a missing
+    property. Returns None if one of them is null, as it then cannot be told
+    from a missing one. Strings are interned, so that the many objects that
+    share a type, spec version or timestamp share one string."""
+    fields = tuple(sys.intern(value) if isinstance(value, str) else value for value in (obj.get(name) for name in MAPPED_FIELDS))
+    if any(value is None and name in obj for name, value in zip(MAPPED_FIELDS, fields)):
+        return None
+    return fields
+
+
+class MappedObject(object):
+    """A stored STIX object held in a MappedStore as its JSON text.
+
+    Supports the read-only mapping access of the stored objects it stands for.
+    Its MAPPED_FIELDS are kept in ``fields``, so filters read them without
+    decoding the object; any other access decodes it.
+    """
+
+    __slots__ = ("store", "offset", "length", "fields")
+
+    def __init__(self, store, offset, length, fields):
+        self.store = store
+        self.offset = offset
+        self.length = length
+        self.fields = fields
+
+    def __reduce__(self):
+        return MappedObject, (self.store, self.offset, self.length, self.fields)
+
+    def raw(self):
+        """Return the JSON text of the object, encoded as UTF-8."""
+        return self.store.read(self.offset, self.length)
+
+    def to_dict(self):
+        return json.loads(self.raw().decode("utf-8"))
+
+    def __getitem__(self, key):
+        if self.fields is not None and key in MAPPED_FIELD_INDEX:
+            value = self.fields[MAPPED_FIELD_INDEX[key]]
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self.to_dict()[key]
+
+    def __contains__(self, key):
+        if self.fields is not None and key in MAPPED_FIELD_INDEX:
+            return self.fields[MAPPED_FIELD_INDEX[key]] is not None
+        return key in self.to_dict()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def values(self):
+        return self.to_dict().values()
+
+    def items(self):
+        return self.to_dict().items()
+
+    def __eq__(self, other):
+        if isinstance(other, MappedObject):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "MappedObject({!r})".format(self.to_dict())
+
+
+def is_mapped_snapshot(filename):
+    """Tell whether ``filename`` holds a mapped snapshot."""
+    try:
+        with io.open(filename, "rb") as infile:
+            return infile.read(len(MAPPED_SNAPSHOT_MAGIC)) == MAPPED_SNAPSHOT_MAGIC
+    except (IOError, OSError):
+        return False
+
+
+def dump_mapped_snapshot(state, outfile):
+    """Write ``state`` to the binary file object ``outfile`` as a mapped
+    snapshot: the JSON text of every stored object (with sorted keys) in the
+    objects region, and the state with the objects of its "object_index"
+    replaced, in place, by MappedObjects of that region."""
+    outfile.write(MAPPED_SNAPSHOT_MAGIC)
+    outfile.write(REGION_SIZE.pack(0))
+    store = MappedStore()
+    offset = 0
+    for index in state["object_index"].values():
+        for versions in index.values():
+            for version, obj in versions.items():
+                if isinstance(obj, MappedObject):
+                    text, fields = obj.raw(), obj.fields
+                else:
+                    text, fields = json.dumps(obj, sort_keys=True).encode("utf-8"), mapped_fields(obj)
+                outfile.write(text)
+                versions[version] = MappedObject(store, offset, len(text), fields)
+                offset += len(text)
+    pickle.dump(dict(state, store=store), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    outfile.seek(len(MAPPED_SNAPSHOT_MAGIC))
+    outfile.write(REGION_SIZE.pack(offset))
+    outfile.seek(0, io.SEEK_END)
+
+
+def load_mapped_snapshot(filename):
+    """Read a mapped snapshot written by ``dump_mapped_snapshot``. Its objects
+    region is mapped, not read. Snapshots are pickles: only load files written
+    by this server."""
+    with io.open(filename, "rb") as infile:
+        if infile.read(len(MAPPED_SNAPSHOT_MAGIC)) != MAPPED_SNAPSHOT_MAGIC:
+            raise ValueError("Not a medallion mapped snapshot")
+        size, = REGION_SIZE.unpack(infile.read(REGION_SIZE.size))
+        start = infile.tell()
+        infile.seek(start + size)
+        state = load_state(infile)
+        state.pop("store").open(infile, start)
+    return state
+
+
+class WriteAheadLog(object):
+    """Append-only journal of write operations, one JSON record per line.
+
+    Records are flushed (and by default fsync'ed) before ``append`` returns, so an
+    operation that was logged survives a crash. The operations captured by a
+    snapshot are dropped from the log with ``discard`` (or ``truncate``).
+
+    Args:
+        filename (str): path of the log file, created if it does not exist
+        sync (bool): fsync the log after each record
+
+    """
+
+    def __init__(self, filename, sync=True):
+        self.filename = filename
+        self.sync = sync
+        self.count = 0
+        # end of the complete records found by the last replay
+        self.complete = 0
+        self._file = io.open(filename, "ab")
+
+    def append(self, record):
+        self._file.write(json.dumps(record).encode("utf-8") + b"\n")
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self.count += 1
+
+    def replay(self):
+        """Yield the records currently in the log, oldest first. A record cut
+        short at the end of the log (an interrupted append) is ignored, and
+        ``complete`` set to the end of the records before it, see ``trim``.
+        Records that cannot be read are skipped."""
+        self.complete = 0
+        with io.open(self.filename, "rb") as infile:
+            for line_number, line in enumerate(infile, 1):
+                if not line.endswith(b"\n"):
+                    log.warning("Ignoring incomplete record at line {} of {}".format(line_number, self.filename))
+                    return
+                self.complete += len(line)
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    log.warning("Skipping unreadable record at line {} of {}".format(line_number, self.filename))
+                    continue
+                yield record
+
+    def trim(self):
+        """Drop an incomplete record left at the end of the log, once ``replay``
+        went through it. The next append would otherwise be joined to it, and
+        both lost."""
+        if self._file.tell() > self.complete:
+            self._file.truncate(self.complete)
+            self._file.seek(self.complete)
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+
+    def tell(self):
+        """Return the end of the records appended so far, for ``discard``."""
+        return self._file.tell()
+
+    def discard(self, offset):
+        """Drop the records before ``offset``, a value returned by ``tell``,
+        keeping those appended since."""
+        if offset >= self.tell():
+            self.truncate()
+            return
+        with io.open(self.filename, "rb") as infile:
+            infile.seek(offset)
+            rest = infile.read()
+        self.close()
+        replace_file(self.filename, lambda outfile: outfile.write(rest))
+        self._file = io.open(self.filename, "ab")
+        self.count = rest.count(b"\n")
+
+    def truncate(self):
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self.count = 0
+
+    def close(self):
+        self._file.close()
@@ -0,0 +1,318 @@
+import base64
+import fcntl
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+
+from ..common import (
+    datetime_to_float, datetime_to_string, get_timestamp,
+    parse_request_parameters, string_to_datetime
+)
+from ..exceptions import ProcessingError
+from .memory_backend import HIDDEN_FIELDS, MemoryBackend
+from .persistence import (
+    MappedObject, WriteAheadLog, dump_mapped_snapshot, is_mapped_snapshot,
+    load_mapped_snapshot, replace_file
+)
+
+# Module-level logger
+log = logging.getLogger(__name__)
+
+
+class InterProcessLock(object):
+    """Exclusive lock held across the threads of this process and across the
+    processes that open the same ``filename`` (through ``flock``). The lock is
+    reentrant, and must be created in the process that uses it, not inherited
+    through ``fork``."""
+
+    def __init__(self, filename):
+        self._thread_lock = threading.RLock()
+        self._file = io.open(filename, "ab")
+        self._depth = 0
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SharedLog(WriteAheadLog):
+    """Write-ahead log appended to by several processes, each of which applies
+    the records of the others. ``offset`` is the end of the records this
+    process has applied. Compaction replaces the file by an empty one, which
+    tells the other processes to reload the snapshot."""
+
+    def __init__(self, filename, sync=True):
+        super(SharedLog, self).__init__(filename, sync)
+        self._open_reader()
+
+    def _open_reader(self):
+        self._reader = io.open(self.filename, "rb")
+        self.inode = os.fstat(self._reader.fileno()).st_ino
+        self.offset = 0
+
+    def append(self, record):
+        """Append a record. Must be called holding the inter-process lock, once
+        the records of the other processes were replayed: anything past
+        ``offset`` is then a record cut short by a process that died while
+        appending it, which is dropped so that the new record is not joined to it."""
+        if os.fstat(self._file.fileno()).st_size > self.offset:
+            log.warning("Dropping an incomplete record at the end of {}".format(self.filename))
+            self._file.truncate(self.offset)
+            self._file.seek(self.offset)
+        super(SharedLog, self).append(record)
+        self.offset = self._file.tell()
+
+    def replay(self):
+        """Yield the records appended since the last call, oldest first. A
+        record still being written by another process is left for the next
+        call, and records that cannot be read are skipped."""
+        self._reader.seek(self.offset)
+        new = self._reader.read()
+        end = new.rfind(b"\n") + 1
+        for line in new[:end].splitlines():
+            try:
+                record = json.loads(line.decode("utf-8"))
+            except ValueError:
+                log.warning("Skipping unreadable record in {}".format(self.filename))
+                continue
+            yield record
+        self.offset += end
+
+    def is_stale(self):
+        """Tell whether another process appended to or replaced the log."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return True
+        return stat.st_ino != self.inode or stat.st_size != self.offset
+
+    def is_replaced(self):
+        try:
+            return os.stat(self.filename).st_ino != self.inode
+        except OSError:
+            return True
+
+    def reopen(self):
+        self.close()
+        self._file = io.open(self.filename, "ab")
+        self._open_reader()
+        self.count = 0
+
+    def truncate(self):
+        replace_file(self.filename, lambda outfile: None)
+        self.reopen()
+
+    def tell(self):
+        return self.offset
+
+    def discard(self, offset):
+        """Start a new log holding the records after ``offset``, which this
+        process has applied already."""
+        super(SharedLog, self).discard(offset)
+        self.reopen()
+        self.offset = os.path.getsize(self.filename)
+
+    def close(self):
+        super(SharedLog, self).close()
+        self._reader.close()
+
+
+def plain_object(obj):
+    """Return a stored object as a dict, decoding it if it is mapped."""
+    return obj.to_dict() if isinstance(obj, MappedObject) else obj
+
+
+def args_digest(filter_args):
+    """Return a digest of the normalized filter of a request, see ``parse_request_parameters``."""
+    args = {key: sorted(values) for key, values in parse_request_parameters(filter_args).items()}
+    return hashlib.sha256(json.dumps(args, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def synced(method):
+    """Bring the store up to date with the shared log before running ``method``."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._sync()
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def exclusive(method):
+    """Run ``method`` holding the inter-process lock, on an up to date store."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._file_lock:
+            self._sync()
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class ReplicatedMemoryBackend(MemoryBackend):
+    """MemoryBackend for servers that run several worker processes, which
+    serve one copy of the stored objects.
+
+    The workers share the snapshot and the write-ahead log ("wal_filename",
+    required). Writes are serialized across processes by a ``flock`` on
+    "lock_filename" (by default the log file name followed by ".lock") and
+    appended to the log, and every request first applies the records other
+    workers appended since the last one, so all workers serve the same data.
+    A compaction by any worker rewrites the snapshot and starts a new log; the
+    other workers then reload the snapshot.
+
+    Snapshots are binary, with the objects in a region every worker maps
+    read-only (see ``dump_mapped_snapshot``): the objects of the snapshot are
+    held in memory once, in the page cache, and each worker only keeps its
+    indexes and the objects written since the last compaction. The first
+    worker to start maps the data it loaded by writing a snapshot. Paging
+    sessions are not kept by a worker; the ``next`` token carries the paging
+    cursor instead, so any worker can serve the next page. Create the backend
+    in each worker (not before forking). POSIX only.
+    """
+
+    def __init__(self, **kwargs):
+        if not kwargs.get("wal_filename"):
+            raise ValueError("ReplicatedMemoryBackend requires a wal_filename shared by all workers.")
+        if kwargs.setdefault("snapshot_format", "binary") != "binary":
+            raise ValueError("ReplicatedMemoryBackend only writes binary snapshots, whose objects the workers map.")
+        self._file_lock = InterProcessLock(kwargs.get("lock_filename", kwargs["wal_filename"] + ".lock"))
+        with self._file_lock:
+            super(ReplicatedMemoryBackend, self).__init__(**kwargs)
+            if not is_mapped_snapshot(self.snapshot_filename):
+                self.snapshot()
+
+    def _open_wal(self, wal_filename, sync):
+        if not self.snapshot_filename:
+            raise ValueError("A write-ahead log requires a filename or snapshot_filename to compact into.")
+        self._wal = SharedLog(wal_filename, sync)
+        for record in self._wal.replay():
+            self._replay(record)
+
+    def _sync(self):
+        """Apply the records other workers appended to the shared log, reloading
+        the snapshot first if one of them compacted the log."""
+        if not self._wal.is_stale():
+            return
+        if self._wal.is_replaced():
+            with self._file_lock:
+                if self._wal.is_replaced():
+                    self.load_snapshot(self.snapshot_filename)
+                    with self._lock.write_locked():
+                        self._wal.reopen()
+        with self._lock.write_locked():
+            for record in self._wal.replay():
+                self._replay(record)
+
+    def set_next(self, filter_args, cursor):
+        """Return a ``next`` token carrying the paging cursor, a digest of the
+        normalized filter and the time it was issued. Tokens are not signed: a
+        client can only move its own cursor, over data it may read anyway."""
+        date_added, obj_id, version = cursor
+        token = {
+            "cursor": [date_added, obj_id, datetime_to_string(version)],
+            "args": args_digest(filter_args),
+            "request_time": datetime_to_float(get_timestamp()),
+        }
+        return base64.urlsafe_b64encode(json.dumps(token).encode("utf-8")).decode("ascii")
+
+    def get_next(self, filter_args):
+        """Return the paging cursor carried by the ``next`` token, or None if the
+        request does not continue a session."""
+        n = filter_args.get("next")
+        if n is None:
+            return None
+        try:
+            token = json.loads(base64.urlsafe_b64decode(n.encode("ascii")).decode("utf-8"))
+            date_added, obj_id, version = token["cursor"]
+            cursor = int(date_added), str(obj_id), string_to_datetime(version)
+            expired = datetime_to_float(get_timestamp()) - token["request_time"] > self.timeout
+        except (ValueError, TypeError, KeyError):
+            expired = True
+        if expired:
+            raise ProcessingError("The server did not understand the request or filter parameters: 'next' not valid", 400)
+        if args_digest(filter_args) != token.get("args"):
+            raise ProcessingError("The server did not understand the request or filter parameters: params changed over subsequent transaction", 400)
+        return cursor
+
+    def snapshot(self, filename=None):
+        """Write a snapshot, see ``MemoryBackend.snapshot``. After writing the
+        default snapshot file, its objects are served from the file, as the
+        other workers do once they see the log was compacted."""
+        with self._file_lock:
+            self._sync()
+            super(ReplicatedMemoryBackend, self).snapshot(filename)
+            if filename in (None, self.snapshot_filename):
+                self.load_snapshot(self.snapshot_filename)
+
+    def _dump_binary_snapshot(self, state, outfile):
+        dump_mapped_snapshot(dict(state, version=self.SNAPSHOT_VERSION), outfile)
+
+    def _read_binary_snapshot(self, filename):
+        if is_mapped_snapshot(filename):
+            return load_mapped_snapshot(filename)
+        return super(ReplicatedMemoryBackend, self)._read_binary_snapshot(filename)
+
+    def _restore_collections(self, state):
+        data = super(ReplicatedMemoryBackend, self)._restore_collections(state)
+        for collection in state["collection_lookup"].values():
+            collection["objects"] = [plain_object(obj) for obj in collection["objects"]]
+        return data
+
+    def _export_collection(self, state, api_root, collection):
+        collection = super(ReplicatedMemoryBackend, self)._export_collection(state, api_root, collection)
+        collection["objects"] = [plain_object(obj) for obj in collection["objects"]]
+        return collection
+
+    def _serialize(self, api_root, collection_id, objs):
+        """Mapped objects without internal properties are served as mapped, as
+        their text is encoded like responses are. The others are encoded (and
+        cached) as usual."""
+        fragments = []
+        for obj in objs:
+            if isinstance(obj, MappedObject) and not any(field in obj for field in HIDDEN_FIELDS):
+                fragments.append(obj.raw().decode("utf-8"))
+            else:
+                fragments.extend(super(ReplicatedMemoryBackend, self)._serialize(api_root, collection_id, [obj]))
+        return fragments
+
+    def _compact_wal(self):
+        if os.path.getsize(self._wal.filename):
+            self.snapshot()
+
+    server_discovery = synced(MemoryBackend.server_discovery)
+    get_collections = synced(MemoryBackend.get_collections)
+    get_collection = synced(MemoryBackend.get_collection)
+    get_collection_statistics = synced(MemoryBackend.get_collection_statistics)
+    get_object_manifest = synced(MemoryBackend.get_object_manifest)
+    get_api_root_information = synced(MemoryBackend.get_api_root_information)
+    get_status = synced(MemoryBackend.get_status)
+    get_objects = synced(MemoryBackend.get_objects)
+    get_object = synced(MemoryBackend.get_object)
+    get_object_versions = synced(MemoryBackend.get_object_versions)
+    save_data_to_file = synced(MemoryBackend.save_data_to_file)
+
+    add_objects = exclusive(MemoryBackend.add_objects)
+    delete_object = exclusive(MemoryBackend.delete_object)
+    prune = exclusive(MemoryBackend.prune)
@@ -1,11 +1,22 @@
 import calendar
+import collections
+import contextlib
 import datetime as dt
+import functools
+import json
+import re
 import threading
 import uuid
 
 import pytz
 from six import iteritems
 
+# STIX/TAXII timestamps: "YYYY-MM-DDTHH:MM:SS[.ffffff]Z"
+TIMESTAMP_RE = re.compile(r"(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?Z\Z")
+
+# Number of distinct timestamps whose parsed value is remembered
+TIMESTAMP_CACHE_SIZE = 65536
+
 
 def create_resource(resource_name, items, more=False, next_id=None):
     """Generates a Resource Object given a resource name."""
@@ -20,6 +31,27 @@ def create_resource(resource_name, items, more=False, next_id=None):
     return resource
 
 
+class SerializedEnvelope(dict):
+    """Envelope Resource that also holds the JSON serialization of each of its
+    objects, so a response can be assembled without encoding them again."""
+
+    def __init__(self, resource, fragments):
+        super(SerializedEnvelope, self).__init__(resource)
+        self.fragments = fragments
+
+    def to_json(self, dumps=json.dumps):
+        """Serialize the envelope with sorted keys, joining the object fragments
+        into the "objects" member and encoding the other members with ``dumps``."""
+        members = []
+        for key in sorted(self):
+            if key == "objects":
+                value = "[" + ", ".join(self.fragments) + "]"
+            else:
+                value = dumps(self[key])
+            members.append(dumps(key) + ": " + value)
+        return "{" + ", ".join(members) + "}"
+
+
 def determine_version(new_obj, request_time):
     """Grab the modified time if present, if not grab created time,
     if not grab request time provided by server."""
@@ -145,19 +177,44 @@ def datetime_to_float(dttm):
         return (dttm - dt.datetime(1970, 1, 1, tzinfo=pytz.UTC)).total_seconds()
 
 
+def datetime_to_micros(dttm):
+    """Given a datetime instance, return the integer number of microseconds
+    since the epoch. Timezone-naive instances are assumed to be UTC."""
+    if dttm.tzinfo is not None:
+        dttm = dttm.astimezone(pytz.UTC).replace(tzinfo=None)
+    delta = dttm - dt.datetime(1970, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
 def float_to_datetime(timestamp_float):
     """Given a floating-point number, produce a datetime instance"""
     return dt.datetime.utcfromtimestamp(timestamp_float)
 
 
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
 def string_to_datetime(timestamp_string):
-    """Convert string timestamp to datetime instance."""
+    """Convert string timestamp to datetime instance. The usual STIX/TAXII
+    format is parsed without strptime, and recent results are memoized:
+    the same version and date_added strings are parsed over and over."""
+    match = TIMESTAMP_RE.match(timestamp_string)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        return dt.datetime(
+            int(year), int(month), int(day), int(hour), int(minute), int(second),
+            int(fraction.ljust(6, "0")) if fraction else 0,
+        )
     try:
         return dt.datetime.strptime(timestamp_string, "%Y-%m-%dT%H:%M:%S.%fZ")
     except ValueError:
         return dt.datetime.strptime(timestamp_string, "%Y-%m-%dT%H:%M:%SZ")
 
 
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def string_to_micros(timestamp_string):
+    """Convert string timestamp to integer microseconds since the epoch."""
+    return datetime_to_micros(string_to_datetime(timestamp_string))
+
+
 def generate_status(
     request_time, status, succeeded, failed, pending,
     successes=None, failures=None, pendings=None,
@@ -268,3 +325,86 @@ class SessionChecker(object):
 
     def start(self):
         self.thread.start()
+
+
+class LRUCache(object):
+    """A mapping holding at most ``maxsize`` entries, evicting the least recently
+    used ones first. Safe to share between threads."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ReadWriteLock(object):
+    """A lock that lets any number of readers in at once, or a single writer.
+
+    Waiting writers take priority over new readers so a steady stream of reads
+    cannot starve them. The lock is not reentrant: a thread holding it must not
+    try to acquire it again in either mode.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -1,44 +1,93 @@
-import bisect
-import copy
+import heapq
+import itertools
 import operator
 
-from ..common import determine_spec_version, find_att, string_to_datetime
+from ..common import (
+    determine_spec_version, find_att, string_to_datetime, string_to_micros
+)
 
 
-def check_for_dupes(final_match, final_track, res):
-    for obj in res:
-        found = 0
-        pos = bisect.bisect_left(final_track, obj["id"])
-        if not final_match or pos > len(final_track) - 1 or final_track[pos] != obj["id"]:
-            final_track.insert(pos, obj["id"])
-            final_match.insert(pos, obj)
-        else:
-            obj_time = find_att(obj)
-            while pos != len(final_track) and obj["id"] == final_track[pos]:
-                if find_att(final_match[pos]) == obj_time:
-                    found = 1
-                    break
-                else:
-                    pos = pos + 1
-            if found == 1:
-                continue
-            else:
-                final_track.insert(pos, obj["id"])
-                final_match.insert(pos, obj)
-
-
-def check_version(data, relate):
-    id_track = []
-    res = []
-    for obj in data:
-        pos = bisect.bisect_left(id_track, obj["id"])
-        if not res or pos >= len(id_track) or id_track[pos] != obj["id"]:
-            id_track.insert(pos, obj["id"])
-            res.insert(pos, obj)
-        else:
-            if relate(find_att(obj), find_att(res[pos])):
-                res[pos] = obj
-    return res
+def index_manifest(manifest):
+    """Build an ``(id, version) -> manifest entry`` index over a list of manifest entries."""
+    return {(man["id"], find_att(man)): man for man in manifest}
+
+
+def manifest_lookup(manifest_info):
+    """Return ``manifest_info`` as an ``(id, version)`` index. ``manifest_info``
+    may be a list of manifest entries or an index built by ``index_manifest``."""
+    if isinstance(manifest_info, dict):
+        return manifest_info
+    return index_manifest(manifest_info)
+
+
+def pagination_key(obj, manifest=None):
+    """Return the key results are sorted and paginated by: date_added (in
+    microseconds), then id and version. ``manifest`` is required when ``obj``
+    is a STIX object rather than a manifest entry. Returns None if ``obj`` has
+    no manifest entry."""
+    man = find_manifest_entry(obj, manifest)
+    if man is None:
+        return None
+    return string_to_micros(man["date_added"]), obj["id"], find_att(obj)
+
+
+def find_manifest_entry(obj, manifest=None):
+    """Return the manifest entry of ``obj``, which is ``obj`` itself when no
+    ``manifest`` is given."""
+    if manifest:
+        return manifest.get((obj["id"], find_att(obj)))
+    return obj
+
+
+def spec_version_of(obj):
+    """Return the spec_version of a STIX object or manifest entry."""
+    if "media_type" in obj:
+        return obj["media_type"].split("version=")[1]
+    return determine_spec_version(obj)
+
+
+def id_predicate(id_):
+    ids = frozenset(id_.split(","))
+
+    def match(obj):
+        return obj.get("id") in ids
+
+    return match
+
+
+def type_predicate(type_):
+    types = frozenset(type_.split(","))
+
+    def match(obj):
+        return obj.get("type") in types or ("id" in obj and obj["id"].split("--")[0] in types)
+
+    return match
+
+
+def spec_version_predicate(spec_):
+    specs = frozenset(spec_.split(","))
+
+    def match(obj):
+        return spec_version_of(obj) in specs
+
+    return match
+
+
+def added_after_predicate(added_after_date, manifest_info=None):
+    """Match objects added after ``added_after_date``. Without ``manifest_info``
+    the objects are manifest entries and carry their own date_added."""
+    added_after = string_to_micros(added_after_date)
+    if manifest_info is None:
+        def match(obj):
+            return string_to_micros(obj["date_added"]) > added_after
+    else:
+        manifest = manifest_lookup(manifest_info)
+
+        def match(obj):
+            item = manifest.get((obj["id"], find_att(obj)))
+            return item is not None and string_to_micros(item["date_added"]) > added_after
+
+    return match
 
 
 class BasicFilter(object):
@@ -46,81 +95,117 @@ class BasicFilter(object):
     def __init__(self, filter_args):
         self.filter_args = filter_args
 
-    def sort_and_paginate(self, data, limit, manifest):
-        temp = None
-        next_save = {}
+    def sort_and_paginate(self, data, limit, manifest, after=None):
+        """Return the page of ``data`` that follows the pagination key ``after``,
+        in pagination order. A page of ``limit`` entries is selected with a
+        bounded heap rather than a full sort, and only the first of the
+        remaining entries is returned after it, which tells whether there are
+        more. ``data`` is not modified."""
+        next_save = []
         headers = {}
         new = []
         if len(data) == 0:
             return new, next_save, headers
         if manifest:
-            manifest.sort(key=lambda x: x['date_added'])
-            for man in manifest:
-                man_time = find_att(man)
-                for check in data:
-                    check_time = find_att(check)
-                    if check['id'] == man['id'] and check_time == man_time:
-                        if len(headers) == 0:
-                            headers["X-TAXII-Date-Added-First"] = man["date_added"]
-                        new.append(check)
-                        temp = man
-                        if len(new) == limit:
-                            headers["X-TAXII-Date-Added-Last"] = man["date_added"]
-                        break
-            if limit and limit < len(data):
-                next_save = new[limit:]
-                new = new[:limit]
-            else:
-                headers["X-TAXII-Date-Added-Last"] = temp["date_added"]
+            manifest = manifest_lookup(manifest)
+        keyed = []
+        for obj in data:
+            key = pagination_key(obj, manifest)
+            # objects without a manifest entry are not part of the collection,
+            # and a paging session resumes after its cursor
+            if key is not None and (after is None or key > after):
+                keyed.append((key, obj))
+        if limit and limit < len(keyed):
+            keyed = heapq.nsmallest(limit + 1, keyed, key=operator.itemgetter(0))
         else:
-            data.sort(key=lambda x: x['date_added'])
-            if limit and limit < len(data):
-                next_save = data[limit:]
-                data = data[:limit]
-            headers["X-TAXII-Date-Added-First"] = data[0]["date_added"]
-            headers["X-TAXII-Date-Added-Last"] = data[-1]["date_added"]
-            new = data
+            keyed.sort(key=operator.itemgetter(0))
+        end = limit if limit else len(keyed)
+        new = [obj for _, obj in keyed[:end]]
+        next_save = [obj for _, obj in keyed[end:end + 1]]
+        if new:
+            headers["X-TAXII-Date-Added-First"] = find_manifest_entry(new[0], manifest)["date_added"]
+            headers["X-TAXII-Date-Added-Last"] = find_manifest_entry(new[-1], manifest)["date_added"]
         return new, next_save, headers
 
-    @staticmethod
-    def filter_by_id(data, id_):
-        id_ = id_.split(",")
+    def compile_plan(self, allowed=(), manifest_info=()):
+        """Compile the per-object filters of the request into a list of predicates,
+        the cheapest and most selective first. Filters that group the versions of
+        an object (version, and spec_version without a value) are not part of it."""
+        plan = []
+        match_id = self.filter_args.get("match[id]")
+        if match_id and "id" in allowed:
+            plan.append(id_predicate(match_id))
+        match_type = self.filter_args.get("match[type]")
+        if match_type and "type" in allowed:
+            plan.append(type_predicate(match_type))
+        match_spec_version = self.filter_args.get("match[spec_version]")
+        if match_spec_version and "spec_version" in allowed:
+            plan.append(spec_version_predicate(match_spec_version))
+        added_after_date = self.filter_args.get("added_after")
+        if added_after_date:
+            plan.append(added_after_predicate(added_after_date, manifest_info))
+        return plan
 
-        match_objects = []
+    def filter_lazily(self, source, versions_of, allowed=(), manifest_info=()):
+        """Yield the entries of ``source`` that match the request, evaluating each
+        one only when it is reached. ``versions_of(id)`` must return all the
+        entries of an object: the version and spec_version filters select among
+        the versions of an object that pass the other filters, which are looked
+        up (once per object) when one of its entries is reached."""
+        plan = self.compile_plan(allowed, manifest_info)
 
-        for obj in data:
-            if "id" in obj and any(s == obj["id"] for s in id_):
-                match_objects.append(obj)
+        def matches(obj):
+            return all(match(obj) for match in plan)
 
-        return match_objects
+        match_spec_version = self.filter_args.get("match[spec_version]")
+        match_version = self.filter_args.get("match[version]")
+        group_spec_version = "spec_version" in allowed and not match_spec_version
+        group_version = "version" in allowed and "all" not in (match_version or "last").split(",")
+        selected = {}
+
+        def is_selected(obj):
+            if obj["id"] not in selected:
+                group = [other for other in versions_of(obj["id"]) if matches(other)]
+                if group_spec_version:
+                    group = self.filter_by_spec_version(group, None)
+                if group_version:
+                    group = self.filter_by_version(group, match_version)
+                selected[obj["id"]] = {id(other) for other in group}
+            return id(obj) in selected[obj["id"]]
+
+        for obj in source:
+            if matches(obj) and (not (group_spec_version or group_version) or is_selected(obj)):
+                yield obj
 
     @staticmethod
-    def filter_by_added_after(data, manifest_info, added_after_date):
-        added_after_timestamp = string_to_datetime(added_after_date)
-        new_results = []
-        # for manifest objects and versions
-        if manifest_info is None:
-            for obj in data:
-                if string_to_datetime(obj["date_added"]) > added_after_timestamp:
-                    new_results.append(obj)
-        # for other objects with manifests
+    def paginate_lazily(matches, limit, manifest_info=None):
+        """Take a page from ``matches``, an iterable already in pagination order,
+        reading at most one entry past the page. That entry is returned as the
+        remaining results, which tells whether there are more."""
+        headers = {}
+        if limit:
+            new = list(itertools.islice(matches, limit + 1))
+            new, next_save = new[:limit], new[limit:]
         else:
-            for obj in data:
-                obj_time = find_att(obj)
-                for item in manifest_info:
-                    item_time = find_att(item)
-                    if item["id"] == obj["id"] and item_time == obj_time and string_to_datetime(item["date_added"]) > added_after_timestamp:
-                        new_results.append(obj)
-                        break
-        return new_results
+            new, next_save = list(matches), []
+        if new:
+            manifest = manifest_lookup(manifest_info) if manifest_info else None
+            headers["X-TAXII-Date-Added-First"] = find_manifest_entry(new[0], manifest)["date_added"]
+            headers["X-TAXII-Date-Added-Last"] = find_manifest_entry(new[-1], manifest)["date_added"]
+        return new, next_save, headers
 
     @staticmethod
-    def filter_by_version(data, version):
-        # final_match is a sorted list of objects
-        final_match = []
-        # final_track is a sorted list of id's
-        final_track = []
+    def filter_by_id(data, id_):
+        match = id_predicate(id_)
+        return [obj for obj in data if match(obj)]
+
+    @staticmethod
+    def filter_by_added_after(data, manifest_info, added_after_date):
+        match = added_after_predicate(added_after_date, manifest_info)
+        return [obj for obj in data if match(obj)]
 
+    @staticmethod
+    def filter_by_version(data, version):
         # return most recent object versions unless otherwise specified
         if version is None:
             version = "last"
@@ -130,109 +215,75 @@ class BasicFilter(object):
             # if "all" is in the list, just return everything
             return data
 
-        actual_dates = [string_to_datetime(x) for x in version_indicators if x != "first" and x != "last"]
-        # if a specific version is given, filter for objects with that value
-        if actual_dates:
-            id_track = []
-            res = []
-            for obj in data:
-                obj_time = find_att(obj)
-                if obj_time in actual_dates:
-                    pos = bisect.bisect_left(id_track, obj["id"])
-                    id_track.insert(pos, obj["id"])
-                    res.insert(pos, obj)
-            final_match = res
-            final_track = id_track
-
-        if "first" in version_indicators:
-            res = check_version(data, operator.lt)
-            check_for_dupes(final_match, final_track, res)
-
-        if "last" in version_indicators:
-            res = check_version(data, operator.gt)
-            check_for_dupes(final_match, final_track, res)
-
-        return final_match
-
-    @staticmethod
-    def filter_by_type(data, type_):
-        type_ = type_.split(",")
-        match_objects = []
+        actual_dates = {string_to_datetime(x) for x in version_indicators if x != "first" and x != "last"}
+        first = "first" in version_indicators
+        last = "last" in version_indicators
 
+        # a single pass: objects with a requested version are kept, and the
+        # first and last versions are tracked per id. Results are keyed by
+        # (id, version) so an object selected more than once is returned once.
+        selected = {}
+        firsts = {}
+        lasts = {}
         for obj in data:
-            if "type" in obj and any(s == obj["type"] for s in type_):
-                match_objects.append(obj)
-            elif "id" in obj and any(s == obj["id"].split("--")[0] for s in type_):
-                match_objects.append(obj)
+            obj_id = obj["id"]
+            obj_time = find_att(obj)
+            if obj_time in actual_dates:
+                selected[(obj_id, obj_time)] = obj
+            if first:
+                current = firsts.get(obj_id)
+                if current is None or obj_time < current[0]:
+                    firsts[obj_id] = (obj_time, obj)
+            if last:
+                current = lasts.get(obj_id)
+                if current is None or obj_time > current[0]:
+                    lasts[obj_id] = (obj_time, obj)
+
+        for obj_time, obj in itertools.chain(firsts.values(), lasts.values()):
+            selected.setdefault((obj["id"], obj_time), obj)
+        return list(selected.values())
 
-        return match_objects
+    @staticmethod
+    def filter_by_type(data, type_):
+        match = type_predicate(type_)
+        return [obj for obj in data if match(obj)]
 
     @staticmethod
     def filter_by_spec_version(data, spec_):
-        match_objects = []
-
         if spec_:
-            spec_ = spec_.split(",")
-            for obj in data:
-                if "media_type" in obj:
-                    if any(s == obj["media_type"].split("version=")[1] for s in spec_):
-                        match_objects.append(obj)
-                elif any(s == determine_spec_version(obj) for s in spec_):
-                    match_objects.append(obj)
-        else:
-            for obj in data:
-                add = True
-                if "media_type" in obj:
-                    s1 = obj["media_type"].split("version=")[1]
-                else:
-                    s1 = determine_spec_version(obj)
-                for match in data:
-                    if "media_type" in match:
-                        s2 = match["media_type"].split("version=")[1]
-                    else:
-                        s2 = determine_spec_version(match)
-                    if obj["id"] == match["id"] and s2 > s1:
-                        add = False
-                if add:
-                    match_objects.append(obj)
-        return match_objects
-
-    def process_filter(self, data, allowed=(), manifest_info=(), limit=None):
-        filtered_by_type = []
-        filtered_by_id = []
+            match = spec_version_predicate(spec_)
+            return [obj for obj in data if match(obj)]
+
+        # keep the latest spec_version of each object
+        specs = [spec_version_of(obj) for obj in data]
+        latest = {}
+        for obj, spec in zip(data, specs):
+            if spec > latest.get(obj["id"], ""):
+                latest[obj["id"]] = spec
+        return [obj for obj, spec in zip(data, specs) if spec == latest[obj["id"]]]
+
+    def process_filter(self, data, allowed=(), manifest_info=(), limit=None, after=None):
+        filtered_by_plan = []
         filtered_by_spec_version = []
-        filtered_by_added_after = []
         filtered_by_version = []
         final_match = []
         save_next = []
         headers = {}
 
-        # match for type and id filters first
-        match_type = self.filter_args.get("match[type]")
-        if match_type and "type" in allowed:
-            filtered_by_type = self.filter_by_type(data, match_type)
-        else:
-            filtered_by_type = copy.deepcopy(data)
-
-        match_id = self.filter_args.get("match[id]")
-        if match_id and "id" in allowed:
-            filtered_by_id = self.filter_by_id(filtered_by_type, match_id)
-        else:
-            filtered_by_id = filtered_by_type
-
-        # match for added_after
-        added_after_date = self.filter_args.get("added_after")
-        if added_after_date:
-            filtered_by_added_after = self.filter_by_added_after(filtered_by_id, manifest_info, added_after_date)
+        # match for type, id, spec_version and added_after in a single pass
+        plan = self.compile_plan(allowed, manifest_info)
+        if plan:
+            filtered_by_plan = [obj for obj in data if all(match(obj) for match in plan)]
         else:
-            filtered_by_added_after = filtered_by_id
+            # shallow copy: stored objects are shared and must not be mutated here
+            filtered_by_plan = list(data)
 
-        # match for spec_version
+        # without a value, keep the latest spec_version of each object
         match_spec_version = self.filter_args.get("match[spec_version]")
-        if "spec_version" in allowed:
-            filtered_by_spec_version = self.filter_by_spec_version(filtered_by_added_after, match_spec_version)
+        if "spec_version" in allowed and not match_spec_version:
+            filtered_by_spec_version = self.filter_by_spec_version(filtered_by_plan, match_spec_version)
         else:
-            filtered_by_spec_version = filtered_by_added_after
+            filtered_by_spec_version = filtered_by_plan
 
         # match for version, and get rid of duplicates as appropriate
         if "version" in allowed:
@@ -242,6 +293,6 @@ class BasicFilter(object):
             filtered_by_version = filtered_by_spec_version
 
         # sort objects by date_added of manifest and paginate as necessary
-        final_match, save_next, headers = self.sort_and_paginate(filtered_by_version, limit, manifest_info)
+        final_match, save_next, headers = self.sort_and_paginate(filtered_by_version, limit, manifest_info, after)
 
         return final_match, save_next, headers
@@ -0,0 +1,241 @@
+import bisect
+import itertools
+
+import numpy as np
+
+from ..common import datetime_to_micros, string_to_datetime, string_to_micros
+from .basic_filter import BasicFilter, spec_version_of
+
+
+def encode(values):
+    """Return the sorted distinct ``values`` and the integer code of each of
+    them. Codes compare like the values they stand for."""
+    uniques = sorted(set(values))
+    lookup = {value: code for code, value in enumerate(uniques)}
+    return uniques, np.fromiter((lookup[value] for value in values), dtype=np.int64, count=len(values))
+
+
+def merge_codes(uniques, codes, other_uniques, other_codes):
+    """Merge two encodings (see ``encode``) into one. Returns the sorted distinct
+    values of both, and both code arrays recoded into them. The values only in
+    ``other_uniques`` are expected to be few."""
+    inserted = [value for value in other_uniques if not codes_of(uniques, [value])]
+    if inserted:
+        # a code moves up by the number of inserted values that sort before its value
+        points = np.array([bisect.bisect_left(uniques, value) for value in inserted], dtype=np.int64)
+        codes = codes + np.searchsorted(points, codes, side="right")
+        uniques = sorted(uniques + inserted)
+    recode = np.array(codes_of(uniques, other_uniques), dtype=np.int64)
+    return uniques, codes, recode[other_codes]
+
+
+def codes_of(uniques, values):
+    """Return the codes of those ``values`` that appear in ``uniques``."""
+    codes = []
+    for value in values:
+        pos = bisect.bisect_left(uniques, value)
+        if pos < len(uniques) and uniques[pos] == value:
+            codes.append(pos)
+    return codes
+
+
+def group_extreme(groups, values, mask, last=True):
+    """Return the rows of ``mask`` holding the largest (``last``) or smallest
+    value of their group, among the rows of ``mask``."""
+    rows = np.flatnonzero(mask)
+    if len(rows) == 0:
+        return mask.copy()
+    order = rows[np.lexsort((values[rows], groups[rows]))]
+    ordered_groups = groups[order]
+    boundary = ordered_groups[1:] != ordered_groups[:-1]
+    if last:
+        ends = np.append(boundary, True)
+    else:
+        ends = np.insert(boundary, 0, True)
+    best = np.zeros(groups.max() + 1, dtype=values.dtype)
+    best[ordered_groups[ends]] = values[order[ends]]
+    return mask & (values == best[groups])
+
+
+class ColumnarIndex(object):
+    """Column-oriented copy of the manifest of a collection, used by
+    ColumnarFilter.
+
+    Built from ``(id, version, manifest entry, object)`` rows, the object
+    being None when the collection does not store it. Row ``i`` is the
+    manifest entry ``manifest[i]`` and the object ``objects[i]``, and
+    ``stored`` tells which rows have an object. Ids, types and spec versions
+    are integer codes into sorted lists, versions and date_added are epoch
+    microseconds. The type of a row is the prefix of its id.
+
+    The index follows the writes to the collection through ``update``: rows
+    are appended, and removed rows are only marked as such in ``alive`` until
+    they make up a quarter of the index.
+    """
+
+    def __init__(self, rows):
+        self.objects = []
+        self.manifest = []
+        keys, ids, types, specs, versions, dates, stored = [], [], [], [], [], [], []
+        # a collection has few media types
+        spec_of = {}
+        for obj_id, version, man, obj in rows:
+            keys.append((obj_id, version))
+            self.objects.append(obj)
+            self.manifest.append(man)
+            ids.append(obj_id)
+            types.append(obj_id.split("--")[0])
+            media_type = man["media_type"]
+            if media_type not in spec_of:
+                spec_of[media_type] = spec_version_of(man)
+            specs.append(spec_of[media_type])
+            versions.append(datetime_to_micros(version))
+            dates.append(string_to_micros(man["date_added"]))
+            stored.append(obj is not None)
+        self.ids, self.id_code = encode(ids)
+        self.types, self.type_code = encode(types)
+        self.specs, self.spec_code = encode(specs)
+        self.version = np.array(versions, dtype=np.int64)
+        self.date_added = np.array(dates, dtype=np.int64)
+        self.stored = np.array(stored, dtype=bool)
+        self.alive = np.ones(len(keys), dtype=bool)
+        # (id, version) -> row, for the rows that are alive
+        self.row_of = {key: row for row, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.objects)
+
+    def update(self, added=(), removed=()):
+        """Remove the rows of the ``(id, version)`` keys in ``removed``, then add
+        the ``(id, version, manifest entry, object)`` rows in ``added``, which
+        replace the rows of the same keys."""
+        added = list(added)
+        for key in itertools.chain(removed, (row[:2] for row in added)):
+            row = self.row_of.pop(key, None)
+            if row is not None:
+                self.alive[row] = False
+                self.objects[row] = self.manifest[row] = None
+        if added:
+            self._append(ColumnarIndex(added))
+        if np.count_nonzero(~self.alive) * 4 > len(self):
+            self._compact()
+
+    def _append(self, other):
+        offset = len(self)
+        self.objects.extend(other.objects)
+        self.manifest.extend(other.manifest)
+        self.row_of.update((key, offset + row) for key, row in other.row_of.items())
+        self.ids, id_code, other_id_code = merge_codes(self.ids, self.id_code, other.ids, other.id_code)
+        self.types, type_code, other_type_code = merge_codes(self.types, self.type_code, other.types, other.type_code)
+        self.specs, spec_code, other_spec_code = merge_codes(self.specs, self.spec_code, other.specs, other.spec_code)
+        self.id_code = np.concatenate((id_code, other_id_code))
+        self.type_code = np.concatenate((type_code, other_type_code))
+        self.spec_code = np.concatenate((spec_code, other_spec_code))
+        for column in ("version", "date_added", "stored", "alive"):
+            setattr(self, column, np.concatenate((getattr(self, column), getattr(other, column))))
+
+    def _compact(self):
+        """Drop the rows that are not alive. Codes are left as they are."""
+        keep = np.flatnonzero(self.alive)
+        position = np.cumsum(self.alive) - 1
+        self.objects = [self.objects[row] for row in keep.tolist()]
+        self.manifest = [self.manifest[row] for row in keep.tolist()]
+        self.row_of = {key: int(position[row]) for key, row in self.row_of.items()}
+        for column in ("id_code", "type_code", "spec_code", "version", "date_added", "stored", "alive"):
+            setattr(self, column, getattr(self, column)[keep])
+
+
+class ColumnarFilter(BasicFilter):
+    """BasicFilter evaluated over a ColumnarIndex: each filter is a vectorized
+    mask over all the rows, version selections are sorted group reductions,
+    and only the rows of the requested page are materialized."""
+
+    def __init__(self, filter_args, columns):
+        super(ColumnarFilter, self).__init__(filter_args)
+        self.columns = columns
+
+    @staticmethod
+    def build_index(rows):
+        return ColumnarIndex(rows)
+
+    def select(self, allowed=(), stored_only=False):
+        """Return the boolean mask of the rows matching the request. With
+        ``stored_only``, rows without an object are left out before the versions
+        of each object are grouped, as they are not among the objects."""
+        columns = self.columns
+        mask = columns.alive & columns.stored if stored_only else columns.alive.copy()
+
+        match_id = self.filter_args.get("match[id]")
+        if match_id and "id" in allowed:
+            mask &= np.isin(columns.id_code, codes_of(columns.ids, match_id.split(",")))
+        match_type = self.filter_args.get("match[type]")
+        if match_type and "type" in allowed:
+            mask &= np.isin(columns.type_code, codes_of(columns.types, match_type.split(",")))
+        match_spec_version = self.filter_args.get("match[spec_version]")
+        if match_spec_version and "spec_version" in allowed:
+            mask &= np.isin(columns.spec_code, codes_of(columns.specs, match_spec_version.split(",")))
+        added_after_date = self.filter_args.get("added_after")
+        if added_after_date:
+            mask &= columns.date_added > string_to_micros(added_after_date)
+
+        # without a value, keep the latest spec_version of each object
+        if "spec_version" in allowed and not match_spec_version:
+            mask = group_extreme(columns.id_code, columns.spec_code, mask)
+        if "version" in allowed:
+            mask = self.select_versions(mask)
+        return mask
+
+    def select_versions(self, mask):
+        columns = self.columns
+        # return most recent object versions unless otherwise specified
+        version_indicators = (self.filter_args.get("match[version]") or "last").split(",")
+        if "all" in version_indicators:
+            return mask
+
+        selected = np.zeros(len(columns), dtype=bool)
+        actual_dates = [
+            datetime_to_micros(string_to_datetime(x)) for x in version_indicators if x != "first" and x != "last"
+        ]
+        if actual_dates:
+            selected |= mask & np.isin(columns.version, actual_dates)
+        if "first" in version_indicators:
+            selected |= group_extreme(columns.id_code, columns.version, mask, last=False)
+        if "last" in version_indicators:
+            selected |= group_extreme(columns.id_code, columns.version, mask, last=True)
+        return selected
+
+    def after(self, rows, cursor):
+        """Return the mask of ``rows`` that sort after the pagination key ``cursor``."""
+        columns = self.columns
+        date_added, obj_id, version = cursor
+        pos = bisect.bisect_left(columns.ids, obj_id)
+        id_codes = columns.id_code[rows]
+        if pos < len(columns.ids) and columns.ids[pos] == obj_id:
+            id_after = id_codes > pos
+            same_id = id_codes == pos
+        else:
+            id_after = id_codes >= pos
+            same_id = np.zeros(len(rows), dtype=bool)
+        dates = columns.date_added[rows]
+        later_version = columns.version[rows] > datetime_to_micros(version)
+        return (dates > date_added) | ((dates == date_added) & (id_after | (same_id & later_version)))
+
+    def process_filter(self, data, allowed=(), manifest_info=(), limit=None, after=None, stored_only=False):
+        """Filter, sort and paginate like ``BasicFilter.process_filter``. ``data``
+        must be aligned with the rows of the index (``columns.objects``, along
+        with ``stored_only``, or ``columns.manifest``). Only the first of the
+        remaining results is returned after the page, which tells whether there are more."""
+        columns = self.columns
+        headers = {}
+        rows = np.flatnonzero(self.select(allowed, stored_only))
+        if after is not None:
+            rows = rows[self.after(rows, after)]
+        order = rows[np.lexsort((columns.version[rows], columns.id_code[rows], columns.date_added[rows]))]
+        end = limit if limit else len(order)
+        page = order[:end].tolist()
+        new = [data[row] for row in page]
+        next_save = [data[row] for row in order[end:end + 1].tolist()]
+        if page:
+            headers["X-TAXII-Date-Added-First"] = columns.manifest[page[0]]["date_added"]
+            headers["X-TAXII-Date-Added-Last"] = columns.manifest[page[-1]]["date_added"]
+        return new, next_save, headers
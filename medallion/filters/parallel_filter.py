@@ -0,0 +1,162 @@
+import heapq
+import itertools
+import multiprocessing
+import threading
+
+from ..common import find_att
+from .basic_filter import BasicFilter, pagination_key
+
+# Manifest entries are sent to the workers as tuples of these fields
+MANIFEST_FIELDS = ("id", "date_added", "version", "media_type")
+
+# The shards held by a worker process: (api_root, collection_id) -> (manifest
+# entries by (id, version), (id, version) of the entries without a stored object)
+_shards = {}
+
+
+def manifest_row(man):
+    return tuple(man[field] for field in MANIFEST_FIELDS)
+
+
+def add_rows(entries, rows):
+    """Add manifest entries sent as ``manifest_row`` tuples to ``entries``, and
+    return their ``(id, version)`` keys."""
+    keys = []
+    for row in rows:
+        man = dict(zip(MANIFEST_FIELDS, row))
+        keys.append((man["id"], find_att(man)))
+        entries[keys[-1]] = man
+    return keys
+
+
+def load_shard(key, rows, orphans):
+    """Replace the shard of a collection held by this worker process."""
+    entries = {}
+    add_rows(entries, rows)
+    _shards[key] = (entries, set(orphans))
+
+
+def update_shard(key, changes):
+    """Apply ``(added rows, removed keys)`` changes, in order, to the shard of
+    a collection held by this worker process."""
+    entries, orphans = _shards[key]
+    for added, removed in changes:
+        for entry_key in removed:
+            entries.pop(entry_key, None)
+            orphans.discard(entry_key)
+        orphans.difference_update(add_rows(entries, added))
+
+
+def filter_shard(key, filter_args, allowed, limit, after, stored_only):
+    """Apply a request to the shard of a collection held by this worker process.
+    Returns only the pagination keys of the first ``limit`` results, in
+    pagination order. With ``stored_only``, entries without a stored object
+    are left out, as for a request for objects."""
+    entries, orphans = _shards[key]
+    if stored_only and orphans:
+        data = [man for entry_key, man in entries.items() if entry_key not in orphans]
+    else:
+        data = list(entries.values())
+    results, _, _ = BasicFilter(filter_args).process_filter(data, allowed, None, limit, after)
+    return [pagination_key(man) for man in results]
+
+
+class ShardWorkers(object):
+    """Worker processes each holding one shard of the manifest of the
+    collections they filter, all the versions of an object in the same shard.
+
+    A collection is sent to the workers on its first request. Later writes to
+    it are recorded and sent before its next request, so that a request only
+    carries the filters and the paging cursor. Each worker is a pool of one
+    process, which runs what it is sent in order. Workers are spawned rather
+    than forked, as the server process runs threads.
+    """
+
+    def __init__(self, workers):
+        context = multiprocessing.get_context("spawn")
+        self.pools = [context.Pool(1) for _ in range(workers)]
+        # collections held by the workers, and the changes not yet sent to them
+        self.loaded = set()
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def shard_of(self, obj_id):
+        return hash(obj_id) % len(self.pools)
+
+    def _run(self, function, args_by_shard):
+        results = [pool.apply_async(function, args) for pool, args in zip(self.pools, args_by_shard)]
+        return [result.get() for result in results]
+
+    def record(self, key, added=(), removed=()):
+        """Record a change to a collection: ``added`` ``((id, version), manifest
+        entry)`` pairs and ``removed`` ``(id, version)`` keys. Must be called
+        with the store locked exclusively."""
+        if key in self.loaded:
+            self.pending.setdefault(key, []).append((list(added), list(removed)))
+
+    def reset(self):
+        """Forget the collections held by the workers, after the store was replaced."""
+        with self._lock:
+            self.loaded.clear()
+            self.pending.clear()
+
+    def sync(self, key, manifest, orphans):
+        """Bring the shards of a collection up to date: send the whole collection
+        (its ``manifest`` index and ``orphans`` index) the first time, and the
+        recorded changes afterwards."""
+        with self._lock:
+            if key not in self.loaded:
+                orphan_keys = [(obj_id, version) for obj_id, versions in orphans.items() for version in versions]
+                shards = self._split(manifest.items(), orphan_keys)
+                self._run(load_shard, [(key, entries, shard_orphans) for entries, shard_orphans in shards])
+                self.loaded.add(key)
+            elif self.pending.get(key):
+                changes = [[] for _ in self.pools]
+                for added, removed in self.pending.pop(key):
+                    for shard_changes, change in zip(changes, self._split(added, removed)):
+                        shard_changes.append(change)
+                self._run(update_shard, [(key, shard_changes) for shard_changes in changes])
+
+    def _split(self, entries, keys):
+        """Split ``((id, version), manifest entry)`` pairs and ``(id, version)``
+        keys by shard. Returns an ``(entries as manifest_row tuples, keys)``
+        pair per shard."""
+        shards = [([], []) for _ in self.pools]
+        for entry_key, man in entries:
+            shards[self.shard_of(entry_key[0])][0].append(manifest_row(man))
+        for entry_key in keys:
+            shards[self.shard_of(entry_key[0])][1].append(entry_key)
+        return shards
+
+    def filter(self, key, *args):
+        return self._run(filter_shard, [(key,) + args] * len(self.pools))
+
+    def close(self):
+        for pool in self.pools:
+            pool.terminate()
+            pool.join()
+
+
+class ParallelFilter(BasicFilter):
+    """BasicFilter evaluated by ShardWorkers over the shards of a collection.
+
+    Every shard returns its first results past the paging cursor, which are
+    merged in pagination order. As all the versions of an object are in the
+    same shard, the version and spec_version filters see all of them.
+    """
+
+    def __init__(self, filter_args, workers):
+        super(ParallelFilter, self).__init__(filter_args)
+        self.workers = workers
+
+    def process_shards(self, key, allowed=(), limit=None, after=None, stored_only=False):
+        """Return the pagination keys of the page of a collection that follows
+        ``after``, and those of the next result if there is one. The shards
+        must be in sync, see ``ShardWorkers.sync``."""
+        per_shard = limit + 1 if limit else None
+        results = self.workers.filter(key, self.filter_args, allowed, per_shard, after, stored_only)
+        merged = heapq.merge(*results)
+        if not limit:
+            return list(merged), []
+        keys = list(itertools.islice(merged, limit + 1))
+        return keys[:limit], keys[limit:]
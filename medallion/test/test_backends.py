@@ -224,6 +224,48 @@ def test_add_and_delete_object(backend):
     # assert r.content_type == MEDIA_TYPE_TAXII_V21
 
 
+def test_add_existing_objects(backend):
+    new_objects = copy.deepcopy(backend.TEST_OBJECT)
+    obj = copy.deepcopy(new_objects["objects"][0])
+    obj["modified"] = "2018-01-27T13:49:53.935Z"
+    new_objects["objects"].append(obj)
+    object_id = obj["id"]
+
+    r_post = backend.client.post(
+        test.ADD_OBJECTS_EP,
+        data=json.dumps(copy.deepcopy(new_objects)),
+        headers=backend.post_headers,
+    )
+    assert r_post.status_code == 202
+    assert r_post.json["success_count"] == 2
+
+    # posting the same versions again must not store duplicates
+    r_post = backend.client.post(
+        test.ADD_OBJECTS_EP,
+        data=json.dumps(copy.deepcopy(new_objects)),
+        headers=backend.post_headers,
+    )
+    assert r_post.status_code == 202
+    status_response = r_post.json
+    assert status_response["success_count"] == 0
+    assert status_response["failure_count"] == 2
+
+    r = backend.client.get(
+        test.ADD_OBJECTS_EP + object_id + "/versions",
+        headers=backend.headers,
+        follow_redirects=True,
+    )
+    assert r.status_code == 200
+    assert len(r.json["versions"]) == 2
+
+    r = backend.client.delete(
+        test.ADD_OBJECTS_EP + object_id + "?match[version]=all",
+        headers=backend.headers,
+        follow_redirects=True
+    )
+    assert r.status_code == 200
+
+
 def test_get_object_manifests(backend):
 
     r = backend.client.get(
@@ -318,6 +360,24 @@ def test_get_objects_limit(backend):
         assert objs["objects"][x]["id"] == correct_order[x]
 
 
+def test_get_objects_limit_all_pages(backend):
+    # page through every version one at a time, including versions that share a date_added
+    seen = []
+    url = test.GET_OBJECTS_EP + "?match[version]=all&match[spec_version]=2.0,2.1&limit=1"
+    r = backend.client.get(url, headers=backend.headers)
+    while True:
+        assert r.status_code == 200
+        objs = r.json
+        assert len(objs["objects"]) == 1
+        seen.append((objs["objects"][0]["id"], common.find_att(objs["objects"][0])))
+        if not objs["more"]:
+            break
+        r = backend.client.get(url + "&next=" + objs["next"], headers=backend.headers)
+
+    assert len(seen) == 8
+    assert len(set(seen)) == 8
+
+
 def test_get_objects_id(backend):
     r = backend.client.get(
         test.GET_OBJECTS_EP + "?match[id]=malware--c0931cc6-c75e-47e5-9036-78fabc95d4ec",
@@ -0,0 +1,49 @@
+from medallion.filters.basic_filter import BasicFilter, pagination_key
+
+
+def manifest_entry(n, version):
+    return {
+        "id": "indicator--00000000-0000-4000-8000-{:012d}".format(n),
+        "date_added": "2017-01-27T13:49:{:02d}.000Z".format(n),
+        "version": version,
+        "media_type": "application/stix+json;version=2.1",
+    }
+
+
+def test_filter_lazily_stops_after_page():
+    entries = [manifest_entry(n, "2017-01-27T13:49:53.935Z") for n in range(50)]
+    entries += [manifest_entry(n, "2016-01-27T13:49:53.935Z") for n in range(50)]
+    consumed = []
+
+    def source():
+        for entry in entries:
+            consumed.append(entry)
+            yield entry
+
+    def versions_of(obj_id):
+        return [entry for entry in entries if entry["id"] == obj_id]
+
+    full_filter = BasicFilter({"match[version]": "last"})
+    matches = full_filter.filter_lazily(source(), versions_of, ("version", "spec_version"), None)
+    page, next_save, headers = full_filter.paginate_lazily(matches, 5, None)
+
+    assert page == entries[:5]
+    assert next_save == [entries[5]]
+    assert len(consumed) == 6
+    assert headers["X-TAXII-Date-Added-Last"] == entries[4]["date_added"]
+
+
+def test_sort_and_paginate_selects_top_entries():
+    entries = [manifest_entry(n, "2017-01-27T13:49:53.935Z") for n in reversed(range(20))]
+    data = list(entries)
+    full_filter = BasicFilter({})
+
+    page, next_save, headers = full_filter.sort_and_paginate(data, 3, None)
+    assert page == [manifest_entry(n, "2017-01-27T13:49:53.935Z") for n in range(3)]
+    assert next_save == [manifest_entry(3, "2017-01-27T13:49:53.935Z")]
+
+    after = pagination_key(page[-1])
+    page, next_save, headers = full_filter.sort_and_paginate(data, 3, None, after)
+    assert page == [manifest_entry(n, "2017-01-27T13:49:53.935Z") for n in range(3, 6)]
+    assert headers["X-TAXII-Date-Added-First"] == page[0]["date_added"]
+    assert data == entries
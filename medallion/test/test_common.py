@@ -0,0 +1,24 @@
+import datetime as dt
+
+import pytest
+
+from medallion.common import (
+    datetime_to_micros, string_to_datetime, string_to_micros
+)
+
+
+@pytest.mark.parametrize("timestamp, expected", [
+    ("2017-01-27T13:49:53.935Z", dt.datetime(2017, 1, 27, 13, 49, 53, 935000)),
+    ("2017-01-27T13:49:53.935382Z", dt.datetime(2017, 1, 27, 13, 49, 53, 935382)),
+    ("2017-01-27T13:49:53Z", dt.datetime(2017, 1, 27, 13, 49, 53)),
+    ("2017-1-27T13:49:53Z", dt.datetime(2017, 1, 27, 13, 49, 53)),
+])
+def test_string_to_datetime(timestamp, expected):
+    assert string_to_datetime(timestamp) == expected
+    assert string_to_micros(timestamp) == datetime_to_micros(expected)
+
+
+@pytest.mark.parametrize("timestamp", ["2017-01-27", "2017-01-27T13:49:53.935", "2017-13-27T13:49:53Z"])
+def test_string_to_datetime_invalid(timestamp):
+    with pytest.raises(ValueError):
+        string_to_datetime(timestamp)
@@ -0,0 +1,561 @@
+import copy
+import json
+import threading
+
+import pytest
+
+from medallion.backends import memory_backend as memory_backend_module
+from medallion.backends.memory_backend import (
+    MemoryBackend, collection_statistics, index_types
+)
+from medallion.common import find_att, get_timestamp, string_to_datetime
+
+from .base_test import TaxiiTest
+
+API_ROOT = "trustgroup1"
+COLLECTION_ID = "365fed99-08fa-fdcd-a1b3-fb247eb41d01"
+FILLED_COLLECTION_ID = "91a7b528-80eb-42ed-a74d-c6fbd5a26116"
+ALLOWED_FILTERS = ("id", "type", "version", "spec_version")
+
+
+def make_indicator(n):
+    return {
+        "type": "indicator",
+        "spec_version": "2.1",
+        "id": "indicator--00000000-0000-4000-8000-{:012d}".format(n),
+        "created": "2017-01-27T13:49:53.935Z",
+        "modified": "2017-01-27T13:49:53.935Z",
+        "pattern": "[file:name = 'foo']",
+        "pattern_type": "stix",
+        "valid_from": "2017-01-27T13:49:53.935Z",
+    }
+
+
+@pytest.fixture
+def memory_backend():
+    return MemoryBackend(filename=TaxiiTest.DATA_FILE)
+
+
+def test_concurrent_reads_and_writes(memory_backend):
+    errors = []
+
+    def writer(start):
+        try:
+            for n in range(start, start + 25):
+                memory_backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(n)]}, get_timestamp())
+        except Exception as e:
+            errors.append(e)
+
+    def reader():
+        try:
+            for _ in range(20):
+                memory_backend.get_objects(API_ROOT, COLLECTION_ID, {"limit": "5"}, ALLOWED_FILTERS, 5)
+                memory_backend._pop_expired_sessions()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(i * 25,)) for i in range(4)]
+    threads += [threading.Thread(target=reader) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    objects, _ = memory_backend.get_objects(API_ROOT, COLLECTION_ID, {}, ALLOWED_FILTERS, None)
+    assert len(objects["objects"]) == 100
+
+
+@pytest.fixture
+def wal_config(tmp_path):
+    data_file = str(tmp_path / "data.json")
+    MemoryBackend(filename=TaxiiTest.DATA_FILE).save_data_to_file(data_file)
+    return {"filename": data_file, "wal_filename": str(tmp_path / "data.wal")}
+
+
+def test_write_ahead_log_replay(wal_config):
+    backend = MemoryBackend(**wal_config)
+    status = backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1), make_indicator(2)]}, get_timestamp())
+    backend.delete_object(API_ROOT, COLLECTION_ID, make_indicator(1)["id"], {}, ("version", "spec_version"))
+
+    # a new backend over the same files sees the logged operations
+    restarted = MemoryBackend(**wal_config)
+    objects, _ = restarted.get_objects(API_ROOT, COLLECTION_ID, {}, ALLOWED_FILTERS, None)
+    assert [obj["id"] for obj in objects["objects"]] == [make_indicator(2)["id"]]
+    assert restarted.get_status(API_ROOT, status["id"]) == status
+
+
+def test_write_ahead_log_torn_record(wal_config):
+    backend = MemoryBackend(**wal_config)
+    backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    backend._wal.close()
+    # a crash in the middle of an append leaves part of a record
+    with open(wal_config["wal_filename"], "ab") as f:
+        f.write(b'{"op": "add", "api_root"')
+
+    restarted = MemoryBackend(**wal_config)
+    status = restarted.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(2)]}, get_timestamp())
+    assert status["status"] == "complete"
+
+    restarted = MemoryBackend(**wal_config)
+    objects, _ = restarted.get_objects(API_ROOT, COLLECTION_ID, {}, ALLOWED_FILTERS, None)
+    assert sorted(obj["id"] for obj in objects["objects"]) == [make_indicator(1)["id"], make_indicator(2)["id"]]
+
+
+def test_snapshot_compacts_write_ahead_log(wal_config):
+    backend = MemoryBackend(**wal_config)
+    backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    backend.snapshot()
+
+    with open(wal_config["wal_filename"], "rb") as f:
+        assert f.read() == b""
+
+    restarted = MemoryBackend(**wal_config)
+    objects, _ = restarted.get_objects(API_ROOT, COLLECTION_ID, {}, ALLOWED_FILTERS, None)
+    assert [obj["id"] for obj in objects["objects"]] == [make_indicator(1)["id"]]
+
+
+def test_write_during_snapshot(wal_config, monkeypatch):
+    backend = MemoryBackend(**wal_config)
+    backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    replace_file = memory_backend_module.replace_file
+
+    def replace_while_writing(filename, write):
+        # the store is not locked while the snapshot is written
+        writer = threading.Thread(
+            target=backend.add_objects,
+            args=(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(2)]}, get_timestamp()),
+        )
+        writer.start()
+        writer.join(5)
+        assert not writer.is_alive()
+        replace_file(filename, write)
+
+    monkeypatch.setattr(memory_backend_module, "replace_file", replace_while_writing)
+    backend.snapshot()
+
+    # the write is not in the snapshot, but is kept in the log
+    with open(wal_config["filename"]) as f:
+        assert make_indicator(2)["id"] not in f.read()
+    assert backend._wal.count == 1
+    restarted = MemoryBackend(**wal_config)
+    objects, _ = restarted.get_objects(API_ROOT, COLLECTION_ID, {}, ALLOWED_FILTERS, None)
+    assert sorted(obj["id"] for obj in objects["objects"]) == [make_indicator(1)["id"], make_indicator(2)["id"]]
+
+
+def test_binary_snapshot(tmp_path):
+    snapshot_file = str(tmp_path / "data.snapshot")
+    backend = MemoryBackend(filename=TaxiiTest.DATA_FILE, snapshot_format="binary")
+    backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    backend.snapshot(snapshot_file)
+
+    restarted = MemoryBackend(snapshot_filename=snapshot_file)
+    assert restarted.data == backend.data
+    assert restarted.object_index == backend.object_index
+    assert restarted.manifest_index == backend.manifest_index
+    objects, _ = restarted.get_object(API_ROOT, COLLECTION_ID, make_indicator(1)["id"], {}, ("version", "spec_version"), None)
+    assert objects["objects"] == [make_indicator(1)]
+
+
+def test_binary_snapshot_of_another_version(tmp_path, monkeypatch):
+    snapshot_file = str(tmp_path / "data.snapshot")
+    backend = MemoryBackend(filename=TaxiiTest.DATA_FILE, snapshot_format="binary")
+    backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    backend.snapshot(snapshot_file)
+
+    # the indexes are rebuilt from the objects and manifest the snapshot holds
+    monkeypatch.setattr(MemoryBackend, "SNAPSHOT_VERSION", MemoryBackend.SNAPSHOT_VERSION + 1)
+    restarted = MemoryBackend(snapshot_filename=snapshot_file)
+    assert restarted._export_data() == backend._export_data()
+    for key in backend.collection_stats:
+        assert restarted.collection_stats[key] == backend.collection_stats[key]
+    assert restarted.collection_stats[(API_ROOT, FILLED_COLLECTION_ID)]["versions"] > 0
+
+
+def test_binary_snapshot_keeps_data_file(wal_config):
+    backend = MemoryBackend(snapshot_format="binary", **wal_config)
+    backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    backend.snapshot()
+
+    # the snapshot is written next to the data file, which is left as it was
+    assert backend.snapshot_filename == wal_config["filename"] + ".snapshot"
+    with open(wal_config["filename"]) as f:
+        assert make_indicator(1)["id"] not in json.dumps(json.load(f))
+    restarted = MemoryBackend(snapshot_format="binary", **wal_config)
+    objects, _ = restarted.get_objects(API_ROOT, COLLECTION_ID, {}, ALLOWED_FILTERS, None)
+    assert [obj["id"] for obj in objects["objects"]] == [make_indicator(1)["id"]]
+
+    with pytest.raises(ValueError):
+        MemoryBackend(snapshot_format="binary", snapshot_filename=wal_config["filename"], **wal_config)
+
+
+def test_manifest_records_exported_as_dicts(memory_backend, tmp_path):
+    memory_backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    manifest, _ = memory_backend.get_object_manifest(API_ROOT, COLLECTION_ID, {"match[id]": make_indicator(1)["id"]}, ALLOWED_FILTERS, None)
+    assert manifest["objects"] == [{
+        "id": make_indicator(1)["id"],
+        "date_added": manifest["objects"][0]["date_added"],
+        "version": "2017-01-27T13:49:53.935Z",
+        "media_type": "application/stix+json;version=2.1",
+    }]
+
+    data_file = str(tmp_path / "data.json")
+    memory_backend.save_data_to_file(data_file)
+    reloaded = MemoryBackend(filename=data_file)
+    assert reloaded.manifest_index == memory_backend.manifest_index
+    assert reloaded._export_data() == memory_backend._export_data()
+
+
+def test_serialized_envelope(memory_backend):
+    memory_backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    objects, _ = memory_backend.get_objects(API_ROOT, COLLECTION_ID, {"limit": "3"}, ALLOWED_FILTERS, 3)
+    assert json.loads(objects.to_json()) == objects
+    assert objects.to_json() == json.dumps(objects, sort_keys=True)
+
+    # the cached text of a version goes away with the version
+    cache = memory_backend.json_cache[(API_ROOT, COLLECTION_ID)]
+    key = (make_indicator(1)["id"], string_to_datetime(make_indicator(1)["modified"]))
+    memory_backend.get_object(API_ROOT, COLLECTION_ID, make_indicator(1)["id"], {}, ("version", "spec_version"), None)
+    assert key in cache
+    memory_backend.delete_object(API_ROOT, COLLECTION_ID, make_indicator(1)["id"], {}, ("version", "spec_version"))
+    assert key not in cache
+
+
+def test_add_objects_bundle(memory_backend):
+    key = (API_ROOT, COLLECTION_ID)
+    indexed = len(memory_backend.date_index[key])
+    old_indicator = dict(make_indicator(2), spec_version="2.0")
+    bundle = [make_indicator(1), make_indicator(1), old_indicator, make_indicator(3)]
+    status = memory_backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": bundle}, get_timestamp())
+
+    assert (status["success_count"], status["failure_count"]) == (3, 1)
+    date_index = memory_backend.date_index[key]
+    assert len(date_index) == indexed + 3
+    assert date_index == sorted(date_index)
+    media_types = memory_backend.collection_lookup[key]["media_types"]
+    assert len(media_types) == len(set(media_types))
+    assert "application/stix+json;version=2.0" in media_types
+
+
+def test_collection_statistics(memory_backend):
+    key = (API_ROOT, FILLED_COLLECTION_ID)
+    before = memory_backend.get_collection_statistics(API_ROOT, FILLED_COLLECTION_ID)
+    updated = dict(make_indicator(1), modified="2018-01-27T13:49:53.935Z")
+    memory_backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(1), updated, make_indicator(2)]}, get_timestamp())
+    memory_backend.delete_object(API_ROOT, FILLED_COLLECTION_ID, make_indicator(2)["id"], {}, ("version", "spec_version"))
+
+    stats = memory_backend.get_collection_statistics(API_ROOT, FILLED_COLLECTION_ID)
+    assert stats["objects"] == before["objects"] + 1
+    assert stats["versions"] == before["versions"] + 2
+    assert stats["types"]["indicator"] == before["types"].get("indicator", 0) + 1
+    assert stats["date_added_first"] == before["date_added_first"]
+    assert stats["date_added_last"] > before["date_added_last"]
+    # the maintained counters agree with counters computed from scratch
+    assert memory_backend.collection_stats[key] == collection_statistics(memory_backend.object_index[key], memory_backend.manifest_index[key])
+
+
+def test_retention(memory_backend):
+    key = (API_ROOT, COLLECTION_ID)
+    versions = [dict(make_indicator(1), modified="201{}-01-27T13:49:53.935Z".format(n)) for n in range(4)]
+    memory_backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": versions + [make_indicator(2)]}, get_timestamp())
+
+    memory_backend.collection_lookup[key]["retention"] = {"max_versions": 2}
+    assert memory_backend.prune() == 2
+    assert sorted(memory_backend.object_index[key][make_indicator(1)["id"]]) == [find_att(v) for v in versions[2:]]
+    assert memory_backend.prune() == 0
+
+    memory_backend.collection_lookup[key]["retention"] = {"max_age": 0}
+    assert memory_backend.prune() == 3
+    assert memory_backend.get_collection_statistics(API_ROOT, COLLECTION_ID)["versions"] == 0
+    assert "retention" not in memory_backend.get_collection(API_ROOT, COLLECTION_ID)
+
+
+def test_retention_of_loaded_data(tmp_path):
+    key = (API_ROOT, COLLECTION_ID)
+    with open(TaxiiTest.DATA_FILE) as f:
+        data = json.load(f)
+    for collection in data[API_ROOT]["collections"]:
+        if collection["id"] == COLLECTION_ID:
+            collection["retention"] = {"max_versions": 1}
+    data_file = str(tmp_path / "data.json")
+    with open(data_file, "w") as f:
+        json.dump(data, f)
+
+    backend = MemoryBackend(retention_interval=3600)
+    assert backend._pruner is None
+    backend.load_data_from_file(data_file)
+    assert backend._pruner is not None
+
+    # only the objects given a version over the limit are checked again
+    assert backend.prune() == 0
+    versions = [dict(make_indicator(1), modified="201{}-01-27T13:49:53.935Z".format(n)) for n in range(2)]
+    backend.add_objects(API_ROOT, COLLECTION_ID, {"objects": versions + [make_indicator(5)]}, get_timestamp())
+    assert backend.over_max_versions == {key: {make_indicator(1)["id"]}}
+    assert backend.prune() == 1
+    assert backend.over_max_versions == {}
+    assert list(backend.object_index[key][make_indicator(1)["id"]]) == [find_att(versions[1])]
+
+
+FILTER_ENGINE_ARGS = [
+    {},
+    {"match[version]": "all"},
+    {"match[version]": "first,2018-01-27T13:49:53.935Z"},
+    {"match[type]": "indicator,malware", "match[spec_version]": "2.0,2.1", "match[version]": "all"},
+    {"match[id]": "indicator--00000000-0000-4000-8000-000000000001", "match[version]": "all"},
+    {"added_after": "2017-01-01T00:00:00Z", "limit": "2"},
+    {"match[type]": "indicator", "match[version]": "all", "limit": "3"},
+]
+
+
+def build_columnar_index(backend):
+    """Build the ColumnarIndex of the filled collection now, rather than in the
+    background of the first request that could use it."""
+    key = (API_ROOT, FILLED_COLLECTION_ID)
+    backend._columnar_index(*key)
+    builder = backend._columnar_builds.get(key)
+    if builder is not None:
+        builder.join()
+    assert backend._columnar_index(*key) is not None
+
+
+def assert_same_results(expected_backend, backend, filter_args, prepare=None):
+    """Check that ``backend`` pages through the results of ``filter_args`` like
+    ``expected_backend``, after adding the same objects to both, then calling
+    ``prepare`` (if given) with ``backend``."""
+    versions = [dict(make_indicator(n % 3), modified="201{}-01-27T13:49:53.935Z".format(n % 9)) for n in range(20)]
+    request_time = get_timestamp()
+    for each in (expected_backend, backend):
+        each.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": copy.deepcopy(versions)}, request_time)
+    if prepare is not None:
+        prepare(backend)
+
+    limit = int(filter_args.get("limit", 0)) or None
+    for method in ("get_objects", "get_object_manifest"):
+        expected_args, args = dict(filter_args), dict(filter_args)
+        while True:
+            expected, expected_headers = getattr(expected_backend, method)(API_ROOT, FILLED_COLLECTION_ID, expected_args, ALLOWED_FILTERS, limit)
+            actual, headers = getattr(backend, method)(API_ROOT, FILLED_COLLECTION_ID, args, ALLOWED_FILTERS, limit)
+            assert actual.get("objects") == expected.get("objects")
+            assert headers == expected_headers
+            assert actual.get("more") == expected.get("more")
+            if not expected.get("more"):
+                break
+            expected_args["next"], args["next"] = expected["next"], actual["next"]
+
+
+@pytest.mark.parametrize("filter_args", FILTER_ENGINE_ARGS)
+def test_numpy_filter_engine(filter_args):
+    pytest.importorskip("numpy")
+    basic = MemoryBackend(filename=TaxiiTest.DATA_FILE)
+    columnar = MemoryBackend(filename=TaxiiTest.DATA_FILE, filter_engine="numpy", columnar_threshold=0)
+    assert_same_results(basic, columnar, filter_args, prepare=build_columnar_index)
+
+
+def test_columnar_index_follows_writes():
+    pytest.importorskip("numpy")
+    basic = MemoryBackend(filename=TaxiiTest.DATA_FILE)
+    columnar = MemoryBackend(filename=TaxiiTest.DATA_FILE, filter_engine="numpy", columnar_threshold=0, filter_cache_size=0)
+    key = (API_ROOT, FILLED_COLLECTION_ID)
+    build_columnar_index(columnar)
+    columns = columnar.columnar_index[key]
+
+    # enough deletes for the index to drop the rows removed
+    request_time = get_timestamp()
+    for backend in (basic, columnar):
+        backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(n) for n in range(4)]}, request_time)
+        for n in range(4):
+            backend.delete_object(API_ROOT, FILLED_COLLECTION_ID, make_indicator(n)["id"], {}, ALLOWED_FILTERS)
+    assert columnar.columnar_index[key] is columns
+    assert len(columns) == len(columnar.manifest_index[key])
+    for backend in (basic, columnar):
+        backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(5)]}, request_time)
+
+    for filter_args in ({"match[version]": "all"}, {"match[type]": "indicator"}):
+        for method in ("get_objects", "get_object_manifest"):
+            expected, _ = getattr(basic, method)(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+            actual, _ = getattr(columnar, method)(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+            assert actual == expected
+
+
+def test_columnar_index_built_during_write(monkeypatch):
+    pytest.importorskip("numpy")
+    backend = MemoryBackend(filename=TaxiiTest.DATA_FILE, filter_engine="numpy", columnar_threshold=0, filter_cache_size=0)
+    build_index = backend.filter_engine.build_index
+
+    def build_while_writing(rows):
+        rows = list(rows)
+        backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+        return build_index(rows)
+
+    monkeypatch.setattr(backend.filter_engine, "build_index", build_while_writing)
+    build_columnar_index(backend)
+    objects, _ = backend.get_objects(API_ROOT, FILLED_COLLECTION_ID, {"match[type]": "indicator"}, ALLOWED_FILTERS, None)
+    assert make_indicator(1) in objects["objects"]
+    assert backend._columnar_changes == {}
+
+
+@pytest.fixture(scope="module")
+def parallel_backend():
+    backend = MemoryBackend(filename=TaxiiTest.DATA_FILE, parallel_workers=2, parallel_threshold=0, filter_cache_size=0)
+    yield backend
+    backend.close_filter_pool()
+
+
+@pytest.mark.parametrize("filter_args", FILTER_ENGINE_ARGS)
+def test_parallel_filter(parallel_backend, filter_args):
+    basic = MemoryBackend(filename=TaxiiTest.DATA_FILE)
+    # reset the store, but keep the worker processes of the module's backend
+    parallel_backend.load_data_from_file(TaxiiTest.DATA_FILE)
+    assert_same_results(basic, parallel_backend, filter_args)
+
+
+def test_parallel_filter_after_writes(parallel_backend):
+    parallel_backend.load_data_from_file(TaxiiTest.DATA_FILE)
+    basic = MemoryBackend(filename=TaxiiTest.DATA_FILE)
+    key = (API_ROOT, FILLED_COLLECTION_ID)
+    request_time = get_timestamp()
+    for backend in (basic, parallel_backend):
+        backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(n) for n in range(300)]}, request_time)
+
+    # a first page the date_added scan fills quickly is not sent to the workers
+    parallel_backend.get_objects(API_ROOT, FILLED_COLLECTION_ID, {}, ALLOWED_FILTERS, 2)
+    workers = parallel_backend._shard_workers
+    assert workers is None or key not in workers.loaded
+
+    filter_args = {"match[version]": "all"}
+    parallel_backend.get_objects(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+    assert key in parallel_backend._shard_workers.loaded
+
+    # the workers keep their shards, and only get the writes made since
+    request_time = get_timestamp()
+    for backend in (basic, parallel_backend):
+        backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(n) for n in range(300, 303)]}, request_time)
+        backend.delete_object(API_ROOT, FILLED_COLLECTION_ID, make_indicator(301)["id"], {}, ALLOWED_FILTERS)
+    assert len(parallel_backend._shard_workers.pending[key]) == 2
+    for method in ("get_objects", "get_object_manifest"):
+        expected, _ = getattr(basic, method)(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+        actual, _ = getattr(parallel_backend, method)(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+        assert actual == expected
+    assert not parallel_backend._shard_workers.pending
+
+
+def test_type_index(memory_backend):
+    key = (API_ROOT, FILLED_COLLECTION_ID)
+    memory_backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(1), make_indicator(2)]}, get_timestamp())
+    memory_backend.delete_object(API_ROOT, FILLED_COLLECTION_ID, make_indicator(2)["id"], {}, ("version", "spec_version"))
+    assert memory_backend.type_index[key] == index_types(memory_backend.object_index[key])
+
+    filter_args = {"match[type]": "indicator", "added_after": "2017-01-01T00:00:00Z"}
+    objects, _ = memory_backend.get_objects(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+    manifest, _ = memory_backend.get_object_manifest(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+    assert make_indicator(1)["id"] in [obj["id"] for obj in objects["objects"]]
+    assert [obj["id"] for obj in objects["objects"]] == [man["id"] for man in manifest["objects"]]
+    assert all(obj["type"] == "indicator" for obj in objects["objects"])
+
+
+def test_filter_cache(memory_backend):
+    filter_args = {"match[type]": "indicator", "match[version]": "all"}
+    first, _ = memory_backend.get_objects(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+    second, _ = memory_backend.get_objects(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+    assert second == first
+    assert len(memory_backend.filter_cache) == 1
+
+    # a write to the collection invalidates its cached results
+    memory_backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    third, _ = memory_backend.get_objects(API_ROOT, FILLED_COLLECTION_ID, filter_args, ALLOWED_FILTERS, None)
+    assert third["objects"] == first["objects"] + [make_indicator(1)]
+
+
+ORPHAN_MANIFEST_ENTRY = {
+    "id": "indicator--00000000-0000-4000-8000-999999999999",
+    "date_added": "2016-12-01T00:00:00.000000Z",
+    "version": "2016-12-01T00:00:00.000Z",
+    "media_type": "application/stix+json;version=2.1",
+}
+
+
+@pytest.fixture
+def orphan_data_file(tmp_path):
+    """A data file whose filled collection lists an object it does not store."""
+    with open(TaxiiTest.DATA_FILE) as infile:
+        data = json.load(infile)
+    for collection in data[API_ROOT]["collections"]:
+        if collection["id"] == FILLED_COLLECTION_ID:
+            collection["manifest"].append(dict(ORPHAN_MANIFEST_ENTRY))
+    filename = str(tmp_path / "orphan.json")
+    with open(filename, "w") as outfile:
+        json.dump(data, outfile)
+    return filename
+
+
+@pytest.mark.parametrize("filter_args", [{}, {"match[type]": "indicator"}, {"added_after": "2016-01-01T00:00:00Z"}])
+@pytest.mark.parametrize("limit", [None, 2])
+@pytest.mark.parametrize("engine", ["basic", "numpy", "parallel"])
+def test_manifest_entry_without_object(request, orphan_data_file, filter_args, limit, engine):
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+        backend = MemoryBackend(filename=orphan_data_file, filter_engine="numpy", columnar_threshold=0)
+        build_columnar_index(backend)
+    elif engine == "parallel":
+        backend = request.getfixturevalue("parallel_backend")
+        backend.load_data_from_file(orphan_data_file)
+    else:
+        backend = MemoryBackend(filename=orphan_data_file)
+    pages = {}
+    for method in ("get_objects", "get_object_manifest"):
+        args = dict(filter_args)
+        pages[method] = []
+        while True:
+            page, _ = getattr(backend, method)(API_ROOT, FILLED_COLLECTION_ID, args, ALLOWED_FILTERS, limit)
+            pages[method].extend(page.get("objects", []))
+            if not page.get("more"):
+                break
+            args["next"] = page["next"]
+
+    object_ids = [obj["id"] for obj in pages["get_objects"]]
+    manifest_ids = [man["id"] for man in pages["get_object_manifest"]]
+    assert ORPHAN_MANIFEST_ENTRY["id"] not in object_ids
+    assert ORPHAN_MANIFEST_ENTRY in pages["get_object_manifest"]
+    manifest_ids.remove(ORPHAN_MANIFEST_ENTRY["id"])
+    assert manifest_ids == object_ids
+
+
+def test_add_object_listed_without_object(orphan_data_file):
+    backend = MemoryBackend(filename=orphan_data_file)
+    obj = dict(make_indicator(999999999999), modified=ORPHAN_MANIFEST_ENTRY["version"])
+    backend.add_objects(API_ROOT, FILLED_COLLECTION_ID, {"objects": [obj]}, get_timestamp())
+
+    manifest, _ = backend.get_object_manifest(API_ROOT, FILLED_COLLECTION_ID, {"match[id]": obj["id"]}, ALLOWED_FILTERS, None)
+    assert len(manifest["objects"]) == 1
+    assert manifest["objects"][0]["date_added"] != ORPHAN_MANIFEST_ENTRY["date_added"]
+    assert backend.get_collection_statistics(API_ROOT, FILLED_COLLECTION_ID)["versions"] == 9
+    assert backend.orphan_index[(API_ROOT, FILLED_COLLECTION_ID)] == {}
+
+
+@pytest.mark.parametrize("filter_args", [{"match[spec_version]": "2.1"}, {"match[version]": "2017-01-27T13:49:53.935Z"}, {}])
+@pytest.mark.parametrize("limit", [None, 2])
+@pytest.mark.parametrize("engine", ["basic", "numpy", "parallel"])
+def test_objects_without_manifest_entries(request, tmp_path, filter_args, limit, engine):
+    # a loaded collection may store objects its manifest does not list
+    with open(TaxiiTest.DATA_FILE) as infile:
+        data = json.load(infile)
+    for collection in data[API_ROOT]["collections"]:
+        if collection["id"] == COLLECTION_ID:
+            collection["objects"], collection["manifest"] = [make_indicator(1)], []
+    filename = str(tmp_path / "unlisted.json")
+    with open(filename, "w") as outfile:
+        json.dump(data, outfile)
+
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+        backend = MemoryBackend(filename=filename, filter_engine="numpy", columnar_threshold=0)
+        build_columnar_index(backend)
+    elif engine == "parallel":
+        backend = request.getfixturevalue("parallel_backend")
+        backend.load_data_from_file(filename)
+    else:
+        backend = MemoryBackend(filename=filename)
+    for method in ("get_objects", "get_object_manifest"):
+        args = dict(filter_args, limit=str(limit)) if limit else dict(filter_args)
+        resource, _ = getattr(backend, method)(API_ROOT, COLLECTION_ID, args, ALLOWED_FILTERS, limit)
+        assert not resource.get("objects")
@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+from medallion.backends.memory_backend import MemoryBackend
+from medallion.backends.persistence import MappedObject
+from medallion.backends.replicated_memory_backend import (
+    ReplicatedMemoryBackend
+)
+from medallion.common import get_timestamp
+from medallion.exceptions import ProcessingError
+
+from .base_test import TaxiiTest
+from .test_memory_backend import (
+    ALLOWED_FILTERS, API_ROOT, COLLECTION_ID, FILLED_COLLECTION_ID,
+    FILTER_ENGINE_ARGS, make_indicator
+)
+
+
+@pytest.fixture
+def shared_config(tmp_path):
+    data_file = str(tmp_path / "data.json")
+    MemoryBackend(filename=TaxiiTest.DATA_FILE).save_data_to_file(data_file)
+    return {"filename": data_file, "wal_filename": str(tmp_path / "data.wal")}
+
+
+def object_ids(backend):
+    objects, _ = backend.get_objects(API_ROOT, COLLECTION_ID, {}, ALLOWED_FILTERS, None)
+    return sorted(obj["id"] for obj in objects.get("objects", []))
+
+
+def test_workers_see_each_others_writes(shared_config):
+    # two backends over the same files stand for two worker processes
+    first = ReplicatedMemoryBackend(**shared_config)
+    second = ReplicatedMemoryBackend(**shared_config)
+
+    status = first.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1), make_indicator(2)]}, get_timestamp())
+    assert object_ids(second) == [make_indicator(1)["id"], make_indicator(2)["id"]]
+    assert second.get_status(API_ROOT, status["id"]) == status
+
+    second.delete_object(API_ROOT, COLLECTION_ID, make_indicator(1)["id"], {}, ("version", "spec_version"))
+    assert object_ids(first) == [make_indicator(2)["id"]]
+
+    # re-adding a version another worker added is refused
+    status = second.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(2)]}, get_timestamp())
+    assert status["failure_count"] == 1
+
+
+def test_workers_reload_compacted_log(shared_config):
+    first = ReplicatedMemoryBackend(**shared_config)
+    second = ReplicatedMemoryBackend(**shared_config)
+
+    first.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    first.snapshot()
+    second.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(2)]}, get_timestamp())
+
+    expected = [make_indicator(1)["id"], make_indicator(2)["id"]]
+    assert object_ids(first) == expected
+    assert object_ids(second) == expected
+    assert object_ids(ReplicatedMemoryBackend(**shared_config)) == expected
+
+
+def test_worker_killed_while_appending(shared_config):
+    first = ReplicatedMemoryBackend(**shared_config)
+    second = ReplicatedMemoryBackend(**shared_config)
+    first.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    with open(shared_config["wal_filename"], "ab") as f:
+        f.write(b'{"op": "add", "api_root"')
+
+    # the next append drops the record cut short instead of being joined to it
+    status = second.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(2)]}, get_timestamp())
+    assert status["status"] == "complete"
+    expected = [make_indicator(1)["id"], make_indicator(2)["id"]]
+    assert object_ids(first) == expected
+    assert object_ids(ReplicatedMemoryBackend(**shared_config)) == expected
+
+    # a line that cannot be read is skipped
+    with open(shared_config["wal_filename"], "ab") as f:
+        f.write(b'{"op": "add", "api_root"\n')
+    assert object_ids(first) == expected
+
+
+def test_workers_continue_each_others_pages(shared_config):
+    first = ReplicatedMemoryBackend(**shared_config)
+    second = ReplicatedMemoryBackend(**shared_config)
+    first.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(n) for n in range(5)]}, get_timestamp())
+
+    # the next token carries the paging cursor, so any worker serves the next page
+    filter_args = {"match[type]": "indicator", "limit": "2"}
+    ids = []
+    for backend in (first, second, first):
+        objects, _ = backend.get_objects(API_ROOT, COLLECTION_ID, filter_args, ALLOWED_FILTERS, 2)
+        ids += [obj["id"] for obj in objects["objects"]]
+        filter_args["next"] = objects.get("next")
+    assert ids == [make_indicator(n)["id"] for n in range(5)]
+    assert not objects["more"]
+
+    objects, _ = first.get_objects(API_ROOT, COLLECTION_ID, {"limit": "2"}, ALLOWED_FILTERS, 2)
+    for filter_args in ({"next": objects["next"], "match[type]": "malware"}, {"next": "not a token"}):
+        with pytest.raises(ProcessingError) as e:
+            second.get_objects(API_ROOT, COLLECTION_ID, filter_args, ALLOWED_FILTERS, 2)
+        assert e.value.status == 400
+
+
+def stored_objects(backend):
+    return [obj for index in backend.object_index.values() for versions in index.values() for obj in versions.values()]
+
+
+@pytest.mark.parametrize("filter_args", FILTER_ENGINE_ARGS)
+def test_workers_map_the_snapshot(shared_config, filter_args):
+    basic = MemoryBackend(filename=TaxiiTest.DATA_FILE)
+    first = ReplicatedMemoryBackend(**shared_config)
+    second = ReplicatedMemoryBackend(**shared_config)
+
+    # the objects are served from the snapshot both workers map
+    assert all(isinstance(obj, MappedObject) for obj in stored_objects(second))
+    limit = int(filter_args["limit"]) if "limit" in filter_args else None
+    for method in ("get_objects", "get_object_manifest"):
+        expected, expected_headers = getattr(basic, method)(API_ROOT, FILLED_COLLECTION_ID, dict(filter_args), ALLOWED_FILTERS, limit)
+        actual, headers = getattr(second, method)(API_ROOT, FILLED_COLLECTION_ID, dict(filter_args), ALLOWED_FILTERS, limit)
+        expected.pop("next", None)
+        actual.pop("next", None)
+        assert actual == expected and headers == expected_headers
+        if method == "get_objects":
+            assert json.loads(actual.to_json()) == actual
+
+    # objects written since the last compaction are mapped by the next one
+    first.add_objects(API_ROOT, COLLECTION_ID, {"objects": [make_indicator(1)]}, get_timestamp())
+    assert not any(isinstance(obj, MappedObject) for obj in first.object_index[(API_ROOT, COLLECTION_ID)][make_indicator(1)["id"]].values())
+    first.snapshot()
+    assert object_ids(second) == [make_indicator(1)["id"]]
+    assert all(isinstance(obj, MappedObject) for obj in stored_objects(first) + stored_objects(second))
@@ -1,13 +1,22 @@
 import re
 
-from flask import request
+from flask import json, request
 
+from ..common import SerializedEnvelope
 from ..exceptions import ProcessingError
 
 MEDIA_TYPE_TAXII_ANY = "application/taxii+json"
 MEDIA_TYPE_TAXII_V21 = "{media};version=2.1".format(media=MEDIA_TYPE_TAXII_ANY)
 
 
+def envelope_to_json(envelope):
+    """Serialize an Envelope Resource, reusing the serialized objects of a
+    SerializedEnvelope when the backend provides one."""
+    if isinstance(envelope, SerializedEnvelope):
+        return envelope.to_json(json.dumps)
+    return json.dumps(envelope)
+
+
 def validate_version_parameter_in_accept_header():
     """All endpoints need to check the Accept Header for the correct Media Type"""
     accept_header = request.headers.get("accept", "").replace(" ", "").split(",")
@@ -3,7 +3,10 @@ import re
 
 from flask import Blueprint, Response, current_app, json, request
 
-from . import MEDIA_TYPE_TAXII_V21, validate_version_parameter_in_accept_header
+from . import (
+    MEDIA_TYPE_TAXII_V21, envelope_to_json,
+    validate_version_parameter_in_accept_header
+)
 from .. import auth
 from ..common import get_timestamp
 from ..exceptions import ProcessingError
@@ -117,7 +120,7 @@ def get_or_add_objects(api_root, collection_id):
         )
 
         return Response(
-            response=json.dumps(objects),
+            response=envelope_to_json(objects),
             status=200,
             headers=headers,
             mimetype=MEDIA_TYPE_TAXII_V21,
@@ -169,7 +172,7 @@ def get_or_delete_object(api_root, collection_id, object_id):
         )
         if objects or request.args:
             return Response(
-                response=json.dumps(objects),
+                response=envelope_to_json(objects),
                 status=200,
                 headers=headers,
                 mimetype=MEDIA_TYPE_TAXII_V21,
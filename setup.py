@@ -72,6 +72,9 @@ setup(
         "mongo": [
             "pymongo",
         ],
+        "numpy": [
+            "numpy",
+        ],
     },
     project_urls={
         'Documentation': 'https://medallion.readthedocs.io/',